@@ -0,0 +1,98 @@
+from objects import *
+from optimizer import is_constant
+
+class Diagnostic:
+    def __init__(self, severity, line, msg):
+        """
+        severity -- 'error' or 'warning'
+        line     -- source line of the offending statement
+        """
+        self.severity = severity
+        self.line = line
+        self.message = msg
+
+    def __str__(self):
+        color = 91 if self.severity == 'error' else 93
+        return f"\x1B[{color}m{self.severity}\x1B[39m: line {self.line}: {self.message}"
+
+    def show(self):
+        print(self)
+
+class Analysis:
+    def __init__(self):
+        self.diagnostics = []
+        self.doomed = set()      # ids of revisions whose target precedes the big bang
+        self.futile = set()      # ids of prophecies about events that never happen
+        self.fanout = {}         # mutation position -> positions of revisions targeting it
+
+    def errors(self):
+        return [d for d in self.diagnostics if d.severity == 'error']
+
+    def report(self, statements, file=None):
+        for diagnostic in self.diagnostics:
+            print(diagnostic, file=file)
+        for target, revisions in sorted(self.fanout.items()):
+            mutation = statements[target]
+            lines = ', '.join(str(statements[r].line) for r in revisions)
+            lines = f"lines {lines}" if len(revisions) > 1 else f"line {lines}"
+            spans = sum(r - target for r in revisions)
+            print(f"fan-out: line {mutation.line} ({mutation.left}) is revised by"
+                  f" {len(revisions)} ({lines}), re-executing {spans} statements per pass", file=file)
+
+def analyze(statements, var_count):
+    """
+    Static checks over a reindexed program. Revisions and prophecies only
+    ever refer to a fixed mutation, so a lot can be decided before any
+    universe is spawned.
+    """
+    analysis = Analysis()
+
+    # (name, index) -> position of the mutation that creates that event
+    mutations = {}
+    for pos, assn in enumerate(statements):
+        if assn.kind == Assignment.MUTATION:
+            mutations[(assn.left.name, assn.left.index)] = pos
+
+    revised = set()
+    for pos, assn in enumerate(statements):
+        if assn.kind != Assignment.REVISION:
+            continue
+        event = (assn.left.name, assn.left.index)
+        if assn.left.index < 0 or event not in mutations:
+            analysis.doomed.add(id(assn))
+            analysis.diagnostics.append(Diagnostic('warning', assn.line,
+                f"revision of {assn.left} happens before big-bang and never forks"))
+            continue
+        revised.add(event)
+        analysis.fanout.setdefault(mutations[event], []).append(pos)
+
+    for pos, assn in enumerate(statements):
+        if assn.kind != Assignment.PROPHECY:
+            continue
+        event = (assn.left.name, assn.left.index)
+        if assn.left.index >= var_count.get(assn.left.name, 0):
+            analysis.futile.add(id(assn))
+            analysis.diagnostics.append(Diagnostic('warning', assn.line,
+                f"prophecy about {assn.left} is never checked"))
+            continue
+        # A constant prophecy contradicted by a constant mutation kills every
+        #   universe that gets this far, unless some revision rewrites the event.
+        mutation = statements[mutations[event]]
+        if event in revised or not is_constant(assn.right) or not is_constant(mutation.right):
+            continue
+        if isinstance(assn.right, Undefined) or isinstance(mutation.right, Undefined):
+            continue
+        if assn.right != mutation.right:
+            analysis.diagnostics.append(Diagnostic('error', assn.line,
+                f"prophecy {assn.left} = {assn.right} is contradicted on line"
+                f" {mutation.line} by {mutation.left} = {mutation.right}"))
+
+    return analysis
+
+def prune(statements, analysis):
+    """
+    Drops revisions that can never fork and prophecies that can never be
+    checked. Neither affects any universe, except by the time spent on them.
+    """
+    dead = analysis.doomed | analysis.futile
+    return [assn for assn in statements if id(assn) not in dead]
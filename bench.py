@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+
+# Benchmarks over generated MULTI programs.
+#
+#   bench.py [--quick] [--save] [--tolerance=<fraction>] [<family>...]
+#
+# Every case runs in a fresh interpreter so that peak memory is its own.
+#   Results are compared with those stored in bench.json (written by --save).
+#   What is stored is relative to a calibration workload timed by the same
+#   interpreter, and memory is counted from what it held before the case, so
+#   that a baseline saved on one machine can be checked on another.
+
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from lexer     import *
+from parser    import *
+from engine    import *
+from optimizer import *
+from analysis  import *
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench.json')
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+RULE110 = '''
+input = [{steps}, [{row}]]
+_:+1 = input.0 = 0
+_ = false
+
+factory = [0]
+_:+1 = factory.0 > 1
+_ = false
+factory:0 = [factory.0 + 1]
+
+s = [1, [0, 0] + input.1 + [0, 0], factory]
+r = s.1
+i = s.0
+
+_:+1 = #r ≤ i + 1
+_ = false
+
+factory = s.2
+
+_:+1 = r.(i-1) = 1 and r.i = 1 and r.(i+1) = 1 and factory.(i-1) ≠ 0
+_ = false
+_:+1 = r.(i-1) = 1 and r.i = 1 and r.(i+1) = 0 and factory.(i-1) ≠ 1
+_ = false
+_:+1 = r.(i-1) = 1 and r.i = 0 and r.(i+1) = 1 and factory.(i-1) ≠ 1
+_ = false
+_:+1 = r.(i-1) = 1 and r.i = 0 and r.(i+1) = 0 and factory.(i-1) ≠ 0
+_ = false
+_:+1 = r.(i-1) = 0 and r.i = 1 and r.(i+1) = 1 and factory.(i-1) ≠ 1
+_ = false
+_:+1 = r.(i-1) = 0 and r.i = 1 and r.(i+1) = 0 and factory.(i-1) ≠ 1
+_ = false
+_:+1 = r.(i-1) = 0 and r.i = 0 and r.(i+1) = 1 and factory.(i-1) ≠ 1
+_ = false
+_:+1 = r.(i-1) = 0 and r.i = 0 and r.(i+1) = 0 and factory.(i-1) ≠ 0
+_ = false
+
+s:0 = [i+1, r, factory + [0]]
+s:0 = [i+1, r, factory + [1]]
+
+_:+1 =  #r > i+2
+_ = false
+
+out = factory
+input:0 = [input.0 - 1, factory]
+'''
+
+def rule110(width, steps):
+    # The initial row is a fixed, irregular pattern of the given width.
+    row = ', '.join(str((k * 7 + k // 3) % 2) for k in range(width - 1)) + (', 1' if width > 1 else '1')
+    return RULE110.format(steps=steps, row=row)
+
+def chain(depth):
+    # Every value of x is defined in terms of the next one (x:+1 would be the
+    #   value being assigned), so nothing is known until the last assignment,
+    #   and the outputs then walk every length of the chain.
+    lines = ['x = x:+2 + 1'] * depth + ['x = 0']
+    lines += [f'out = x:-{k}' for k in range(depth, -1, -1)]
+    return '\n'.join(lines) + '\n'
+
+def fanout(width):
+    # The root forks once per revision, and every fork dies at the
+    #   prophecy right after the point it resumes from.
+    lines = ['x = 0', '_:+1 = x > 0', '_ = false']
+    lines += [f'x:0 = {k}' for k in range(1, width + 1)]
+    lines += ['out = x']
+    return '\n'.join(lines) + '\n'
+
+def search(depth):
+    # Every universe forks twice until its bit string is too long, and only
+    #   those of exactly the right length survive to the end.
+    return '\n'.join([
+        'b = []',
+        f'_:+1 = #b > {depth}',
+        '_ = false',
+        'b:0 = b + [0]',
+        'b:0 = b + [1]',
+        f'_:+1 = #b = {depth}',
+        '_ = true',
+        'out = b',
+    ]) + '\n'
+
+def frontend(size):
+    # Straight-line code, heavy on syntax: one universe, many statements.
+    names = [f'v{k}' for k in range(8)]
+    lines = [f'{name} = {k}' for k, name in enumerate(names)]
+    for k in range(size):
+        a, b = names[k % 8], names[(k + 3) % 8]
+        lines.append(f'{a} = ({b} + {k}) × 3 − ({a} % 7)  // step {k}')
+        if k % 4 == 0:
+            lines.append(f't = [{a}, "item {k}", {b} ≥ {k}, [{k}, {k % 5}]]')
+        if k % 16 == 0:
+            lines.append(f'_:+1 = t.0 ≠ {a} ∨ #t = 4')
+            lines.append('_ = true')
+    lines.append(f'out = {names[0]}')
+    return '\n'.join(lines) + '\n'
+
+FAMILIES = {
+    'rule110':  (rule110,  [dict(width=1, steps=10), dict(width=4, steps=20), dict(width=8, steps=30)]),
+    'chain':    (chain,    [dict(depth=50), dict(depth=100), dict(depth=200)]),
+    'fanout':   (fanout,   [dict(width=100), dict(width=500), dict(width=2000)]),
+    'search':   (search,   [dict(depth=6), dict(depth=9), dict(depth=11)]),
+    'frontend': (frontend, [dict(size=500), dict(size=2000), dict(size=4000)]),
+}
+
+def case_name(family, params):
+    return family + '/' + ','.join(f'{k}={v}' for k, v in params.items())
+
+def cases(families=None, quick=False):
+    for family, (generator, sizes) in FAMILIES.items():
+        if families and family not in families:
+            continue
+        for params in (sizes[:1] if quick else sizes):
+            yield case_name(family, params), generator, params
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+def calibrate(tries=5):
+    # Seconds taken by a fixed workload of the sort the engine does (calls,
+    #   attribute and dict lookups, small allocations), best of tries.
+    class Cell:
+        def __init__(self, value):
+            self.value = value
+    best = None
+    for _ in range(tries):
+        started = time.perf_counter()
+        table = {}
+        for k in range(100000):
+            cell = table.get(k & 1023)
+            table[k & 1023] = Cell(k if cell is None else cell.value + k)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure(source):
+    calibration = calibrate()
+    before = peak_memory()
+    started = time.perf_counter()
+    statements = parse_program(TokenStream(source))
+    if isinstance(statements, ParseFailure):
+        raise AssertionError(statements.message)
+    count = reindex(statements)
+    statements = optimize(statements, count)
+    statements = prune(statements, analyze(statements, count))
+    frontend_time = time.perf_counter() - started
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        stats = run(statements, Environment(count))
+
+    return {
+        'frontend (s)':   frontend_time,
+        'run (s)':        stats.wall_time,
+        'statements':     stats.statements,
+        'universes':      stats.spawned,
+        'statements/s':   stats.statements / stats.wall_time,
+        'universes/s':    stats.spawned / stats.wall_time,
+        'peak (MiB)':     peak_memory(),
+        'growth (MiB)':   peak_memory() - before,
+        # Timed again afterwards, which is all the more likely to catch the
+        #   machine as fast as it was during the case.
+        'calibration (s)': min(calibration, calibrate()),
+    }
+
+def relative(result):
+    # The metrics of a result that carry across machines: times and rates
+    #   in units of the calibration workload, and the memory the case took.
+    unit = result['calibration (s)']
+    return {
+        'frontend (units)':     result['frontend (s)'] / unit,
+        'statements/unit':      result['statements/s'] * unit,
+        'universes/unit':       result['universes/s'] * unit,
+        'growth (MiB)':         result['growth (MiB)'],
+    }
+
+# For each relative metric, whether a larger value is better, and the
+#   difference too small to count whatever the ratio, for the smallest cases.
+METRICS = {
+    'frontend (units)':     (False, 0.5),
+    'statements/unit':      (True,  0),
+    'universes/unit':       (True,  0),
+    'growth (MiB)':         (False, 2),
+}
+
+def run_case(name):
+    # Runs a single case in a fresh interpreter.
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), f'--case={name}'],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'{name} failed:\n{proc.stderr}')
+    return json.loads(proc.stdout)
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for metric, (larger_is_better, slack) in METRICS.items():
+        if metric not in baseline or baseline[metric] == 0:
+            continue
+        if abs(result[metric] - baseline[metric]) <= slack:
+            continue
+        ratio = result[metric] / baseline[metric]
+        if (ratio < 1 - tolerance) if larger_is_better else (ratio > 1 + tolerance):
+            regressions.append(f'{metric} {ratio:.2f}×')
+    return regressions
+
+def main(argv):
+    options = {}
+    families = []
+    for arg in argv:
+        if arg.startswith('--'):
+            flag, _, value = arg.partition('=')
+            options[flag] = value
+        else:
+            families.append(arg)
+
+    if '--case' in options:
+        for name, generator, params in cases():
+            if name == options['--case']:
+                print(json.dumps(measure(generator(**params))))
+                return 0
+        print(f'unknown case {options["--case"]}', file=sys.stderr)
+        return 1
+
+    tolerance = float(options.get('--tolerance') or 0.25)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as fh:
+            baseline = json.load(fh)
+
+    results = {}
+    failed = False
+    header = ['statements/s', 'universes/s', 'frontend (s)', 'peak (MiB)']
+    print('case'.ljust(28) + ''.join(h.rjust(14) for h in header))
+    for name, _, _ in cases(families, '--quick' in options):
+        result = run_case(name)
+        results[name] = result
+        cells = [f"{result['statements/s']:.0f}", f"{result['universes/s']:.0f}",
+                 f"{result['frontend (s)']:.3f}", f"{result['peak (MiB)']:.1f}"]
+        line = name.ljust(28) + ''.join(c.rjust(14) for c in cells)
+        if name in baseline:
+            regressions = compare(relative(result), baseline[name], tolerance)
+            if regressions:
+                failed = True
+                line += f"  \x1B[91mregression\x1B[39m: {', '.join(regressions)}"
+        else:
+            line += '  \x1B[2m(no baseline)\x1B[22m'
+        print(line, flush=True)
+
+    if '--save' in options:
+        baseline.update({name: relative(result) for name, result in results.items()})
+        with open(BASELINE, 'w') as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import io
+import os
+import pickle
+
+from objects import *
+
+# Checkpoints are gzipped pickles. Values are pickled as such (and interned
+#   again on load), but the nodes of the program itself -- Assignments,
+#   Variables and expressions, which environments refer to all over -- are
+#   pickled as their position in the program, so a checkpoint can only be
+#   loaded against the program it was taken of.
+
+def fingerprint(statements):
+    text = '\n'.join(str(assn) for assn in statements)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _nodes(statements):
+    # Every node of the program, in a fixed order.
+    nodes = []
+
+    def walk(expr):
+        if isinstance(expr, (Literal, Undefined)) or (isinstance(expr, Tuple) and expr.concrete):
+            return
+        nodes.append(expr)
+        if isinstance(expr, Tuple):
+            for elem in expr.elements:
+                walk(elem)
+        if isinstance(expr, UnaryExpression):
+            walk(expr.operand)
+        if isinstance(expr, BinaryExpression):
+            walk(expr.left)
+            walk(expr.right)
+
+    for assn in statements:
+        nodes.append(assn)
+        nodes.append(assn.left)
+        walk(assn.right)
+    return nodes
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, fh, positions):
+        super().__init__(fh, pickle.HIGHEST_PROTOCOL)
+        self.positions = positions
+
+    def persistent_id(self, obj):
+        return self.positions.get(id(obj))
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, fh, nodes):
+        super().__init__(fh)
+        self.nodes = nodes
+
+    def persistent_load(self, pid):
+        return self.nodes[pid]
+
+class Codec:
+    """
+    Pickles single objects that refer to the nodes of a program.
+    """
+    def __init__(self, statements):
+        self.nodes = _nodes(statements)
+        self.positions = {}
+        for k, node in enumerate(self.nodes):
+            self.positions.setdefault(id(node), k)
+
+    def dumps(self, obj):
+        buf = io.BytesIO()
+        _Pickler(buf, self.positions).dump(obj)
+        return buf.getvalue()
+
+    def loads(self, data):
+        return _Unpickler(io.BytesIO(data), self.nodes).load()
+
+def save(path, statements, state):
+    """
+    Writes state, a dict, to path. The file is only replaced once the new
+    checkpoint is complete.
+    """
+    partial = path + '.partial'
+    with gzip.open(partial, 'wb') as fh:
+        pickler = _Pickler(fh, Codec(statements).positions)
+        pickler.dump(fingerprint(statements))
+        pickler.dump(state)
+    os.replace(partial, path)
+
+def load(path, statements):
+    with gzip.open(path, 'rb') as fh:
+        unpickler = _Unpickler(fh, Codec(statements).nodes)
+        if unpickler.load() != fingerprint(statements):
+            raise AssertionError(f'{path} is a checkpoint of a different program')
+        return unpickler.load()
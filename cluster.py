@@ -0,0 +1,326 @@
+import collections
+import contextlib
+import io
+import multiprocessing
+import os
+import secrets
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import engine
+from engine     import *
+from checkpoint import Codec, fingerprint
+from monitor    import *
+from debug      import *
+
+# Distributed exploration. A coordinator keeps the queue of universes still
+#   to run and hands them out, one at a time, to worker processes that
+#   connect to it over a Unix socket or TCP. A worker runs the universe it is
+#   given with every spawn parked (see Scheduler), and sends back its
+#   outputs, its dbg records, anything else it wrote to stderr, the events
+#   its monitor saw, and the parked children, which the coordinator queues
+#   in turn.
+#
+# Messages are pickled with the Codec of the program, so both ends must have
+#   compiled the same program; workers are turned away otherwise. Pickles
+#   are only safe between trusted parties, so every connection is
+#   authenticated before anything is unpickled: MULTI_AUTHKEY holds the
+#   secret shared by the coordinator and its workers. A coordinator that
+#   listens without one makes one up and prints it, and a worker refuses to
+#   run without one.
+
+def parse_address(address):
+    # host:port for TCP, anything else is the path of a Unix socket.
+    host, colon, port = address.rpartition(':')
+    if colon and '/' not in address and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+def authkey():
+    key = os.environ.get('MULTI_AUTHKEY')
+    return key.encode() if key else None
+
+class Recording(Monitor):
+    """
+    Keeps the events of a universe run by a worker, to be replayed to the
+    monitor of the coordinator. Steps are only kept if asked for, since
+    there is one per statement executed.
+    """
+    def __init__(self, steps=False):
+        self.events = []
+        self.steps = steps
+
+    def start(self, *args):
+        self.events.append(('start', args))
+
+    @property
+    def wants_steps(self):
+        return self.steps
+
+    def step(self, *args):
+        if self.steps:
+            self.events.append(('step', args))
+
+    def spawn(self, *args):
+        self.events.append(('spawn', args))
+
+    def abort(self, *args):
+        self.events.append(('abort', args))
+
+    def finish(self, *args):
+        self.events.append(('finish', args))
+
+def replay_events(events, monitor):
+    for name, args in events:
+        getattr(monitor, name)(*args)
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+def _run_task(code, task):
+    universe, env, start_index, spawned, limits, settings, steps, debugging = task
+    engine.total_spawned = spawned
+    if limits is not None:
+        limits.start()
+    scheduler = Scheduler(None)
+    scheduler.hold()
+    recording = Recording(steps)
+    debug = DebugCollector() if debugging else None
+    outputs = {}
+    with contextlib.redirect_stderr(io.StringIO()) as err:
+        try:
+            run_code_to_completion(code, env, outputs, start_index=start_index, universe=universe,
+                                   monitor=recording, limits=limits, scheduler=scheduler, debug=debug, **settings)
+        except Exception:
+            traceback.print_exc()
+    batches = debug.batches if debug is not None else []
+    return outputs, scheduler.parked, recording.events, batches, err.getvalue()
+
+def work(address, code, key=None, patience=30):
+    """
+    Runs universes for the coordinator at address until it is done. code is
+    the compiled Program; a worker waits up to patience seconds for the
+    coordinator to come up.
+    """
+    codec = Codec(code.statements)
+    given_up = time.monotonic() + patience
+    if key is None:
+        raise AssertionError('MULTI_AUTHKEY is not set; use the one the coordinator printed')
+    while True:
+        try:
+            conn = Client(parse_address(address), authkey=key)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > given_up:
+                raise
+            time.sleep(0.1)
+        except multiprocessing.AuthenticationError:
+            raise AssertionError('the coordinator has a different MULTI_AUTHKEY')
+    with conn:
+        conn.send_bytes(codec.dumps(('hello', fingerprint(code.statements))))
+        while True:
+            try:
+                message = codec.loads(conn.recv_bytes())
+            except EOFError:
+                return
+            match message:
+                case ('run', task):
+                    conn.send_bytes(codec.dumps(('done', _run_task(code, task))))
+                case ('reject', reason):
+                    raise AssertionError(reason)
+                case ('stop',):
+                    return
+
+def _local_worker(address, code, key):
+    # Stopping is up to the coordinator, which sees ^C itself, and a worker
+    #   that turns up after the run is over just goes away.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        work(address, code, key)
+    except OSError:
+        pass
+
+def _wake(address):
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    try:
+        with socket.socket(family) as sock:
+            sock.connect(address)
+    except OSError:
+        pass
+
+class Coordinator:
+    """
+    Runs a whole exploration on workers (see explore). address is where
+    remote workers connect, if any; local is the number of worker processes
+    to start on this machine, forked with the program already compiled.
+    Monitors see the events of each universe once its result comes back.
+    """
+    def __init__(self, address=None, local=0, key=None):
+        assert address is not None or local > 0, "A coordinator without workers would wait forever."
+        self.address = address
+        self.local = local
+        # Anyone who can reach address could otherwise have us unpickle
+        #   whatever they send.
+        self.made_up = key is None and address is not None
+        self.key = secrets.token_hex(16).encode() if self.made_up else key
+        self.peak = 0           # most universes running at once in the last run
+
+    def run(self, code, pending, outputs, monitor, spawned, scheduler=None, limits=None, steps=False, debug=None, **settings):
+        """
+        Runs the universes in pending, a list of (universe, env, start index),
+        and everything they spawn. Returns the number of universes spawned
+        so far in the run, counting the spawned already before.
+        """
+        codec = Codec(code.statements)
+        expected = fingerprint(code.statements)
+        queue = collections.deque(pending)
+        self.peak = 0
+        state = {'busy': 0, 'spawned': spawned, 'workers': 0}
+        changed = threading.Condition()
+
+        def next_task():
+            with changed:
+                while True:
+                    if queue and not (scheduler is not None and scheduler.holding):
+                        universe, env, start_index = entry = queue.popleft()
+                        state['busy'] += 1
+                        self.peak = max(self.peak, state['busy'])
+                        deadline = None
+                        if limits is not None and limits.expires is not None:
+                            deadline = max(0.0, limits.expires - time.perf_counter())
+                        task_limits = None if limits is None else \
+                            Limits(limits.steps, limits.seconds, limits.history, deadline)
+                        debugging = debug is not None and debug.enabled
+                        return entry, (universe, env, start_index, state['spawned'], task_limits, settings, steps, debugging)
+                    if state['busy'] == 0:
+                        changed.notify_all()
+                        return None, None
+                    changed.wait()
+
+        def serve(conn):
+            with conn:
+                try:
+                    kind, found = codec.loads(conn.recv_bytes())
+                    if kind != 'hello' or found != expected:
+                        conn.send_bytes(codec.dumps(('reject', 'the worker compiled a different program')))
+                        print(f"\x1B[93mwarning\x1B[39m: turned away a worker running a different program", file=sys.stderr)
+                        return
+                except Exception:
+                    # Lost, or sent something other than a greeting.
+                    return
+                with changed:
+                    state['workers'] += 1
+                try:
+                    while True:
+                        entry, task = next_task()
+                        if task is None:
+                            conn.send_bytes(codec.dumps(('stop',)))
+                            return
+                        try:
+                            conn.send_bytes(codec.dumps(('run', task)))
+                            _, (done, parked, events, batches, err) = codec.loads(conn.recv_bytes())
+                        except Exception:
+                            # Lost, or sent back something that does not
+                            #   unpickle; the universe goes back in the queue
+                            #   for another worker.
+                            print(f"\x1B[93mwarning\x1B[39m: lost a worker while it ran {entry[0]}", file=sys.stderr)
+                            with changed:
+                                queue.appendleft(entry)
+                                state['busy'] -= 1
+                                changed.notify_all()
+                            return
+                        sys.stderr.write(err)
+                        for batch in batches:
+                            debug.emit(*batch)
+                        replay_events(events, monitor)
+                        for universe, msgs in done.items():
+                            outputs[universe] = msgs
+                        with changed:
+                            queue.extend(parked)
+                            state['spawned'] += len(parked)
+                            state['busy'] -= 1
+                            changed.notify_all()
+                finally:
+                    with changed:
+                        state['workers'] -= 1
+                        changed.notify_all()
+
+        directory = None
+        address = self.address
+        if address is None:
+            directory = tempfile.mkdtemp(prefix='multi-')
+            address = os.path.join(directory, 'coordinator')
+        key = self.key if self.key is not None else os.urandom(32)
+        listener = Listener(parse_address(address), authkey=key)
+        processes = []
+        threads = []
+        acceptor = None
+        closing = False
+        try:
+            # Workers are forked before any thread of ours is started.
+            context = multiprocessing.get_context('fork')
+            for _ in range(self.local):
+                process = context.Process(target=_local_worker, args=(address, code, key), daemon=True)
+                process.start()
+                processes.append(process)
+            if self.address is not None:
+                print(f"waiting for workers on {self.address}", file=sys.stderr)
+                if self.made_up:
+                    print(f"workers must run with MULTI_AUTHKEY={self.key.decode()}", file=sys.stderr)
+
+            def accept():
+                while True:
+                    try:
+                        conn = listener.accept()
+                    except Exception:
+                        # Failed authentication and the like, unless it is
+                        #   the connection that stops us.
+                        if closing:
+                            return
+                        continue
+                    if closing:
+                        conn.close()
+                        return
+                    thread = threading.Thread(target=serve, args=(conn,), daemon=True)
+                    threads.append(thread)
+                    thread.start()
+            acceptor = threading.Thread(target=accept, daemon=True)
+            acceptor.start()
+
+            with changed:
+                while queue and not (scheduler is not None and scheduler.holding) or state['busy'] > 0:
+                    if self.address is None and state['workers'] == 0 \
+                            and not any(p.is_alive() for p in processes):
+                        raise AssertionError('every worker has exited')
+                    changed.wait(1)
+            if scheduler is not None and scheduler.holding:
+                for universe, env, start_index in queue:
+                    scheduler.park(universe, env, start_index)
+        finally:
+            # Closing the listener does not wake up accept, so it is sent one
+            #   last, bare connection; no thread of the run may outlive it, or
+            #   the workers of the next run would be forked with it.
+            closing = True
+            if acceptor is not None:
+                _wake(parse_address(address))
+                acceptor.join(5)
+            listener.close()
+            for thread in threads:
+                thread.join(5)
+            # Workers that were told to stop are gone in a moment; any still
+            #   around never got to connect.
+            until = time.monotonic() + 1
+            for process in processes:
+                process.join(max(0.0, until - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            if directory is not None:
+                shutil.rmtree(directory, ignore_errors=True)
+        return state['spawned']
@@ -0,0 +1,112 @@
+import json
+import sys
+import threading
+
+# The output of dbg statements. Each universe collects what its dbg
+#   statements produce as records in a buffer of its own, without formatting
+#   anything, and hands them to the channel in batches (and when it
+#   finishes); only the channel writes, one batch at a time. A record is
+#
+#   (kind, line, expression, value)
+#
+# where kind is one of
+#
+#   value     a dbg statement whose expression could be evaluated
+#   unknown   one whose expression could not be evaluated (yet)
+#   known     the value of an unknown one, once it could be evaluated
+#
+# and value is None for unknown. Expressions and values are immutable, so
+#   formatting them later gives what formatting them right away would have.
+
+DEBUG_FORMATS = ['text', 'jsonl', 'none']
+
+class DebugBuffer:
+    def __init__(self, channel, universe, verbose):
+        self.channel = channel
+        self.universe = universe
+        self.verbose = verbose
+        self.records = []
+
+    def append(self, kind, line, expr, value=None):
+        self.records.append((kind, line, expr, value))
+        if len(self.records) >= self.channel.batch:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            self.channel.emit(self.universe, self.verbose, self.records)
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.channel.close(self.universe)
+
+class DebugChannel:
+    """
+    Where the output of dbg statements goes, in one of DEBUG_FORMATS:
+
+      text    as it always was, one line per record
+      jsonl   one JSON object per record, with the universe and line
+      none    nowhere; dbg statements are then not even recorded
+
+    file defaults to whatever sys.stderr is when a batch is written. batch
+    is the most records a universe holds before handing them over.
+    """
+    def __init__(self, format='text', file=None, batch=256):
+        assert format in DEBUG_FORMATS, f'unknown debug format "{format}"'
+        self.format = format
+        self.file = file
+        self.batch = batch
+        self.enabled = format != 'none'
+        self.buffers = {}       # universe -> its DebugBuffer, until closed
+        self.lock = threading.Lock()
+
+    def open(self, universe, verbose=False):
+        # A buffer for universe, or None if there is nothing to record.
+        if not self.enabled:
+            return None
+        buffer = DebugBuffer(self, universe, verbose)
+        with self.lock:
+            self.buffers[universe] = buffer
+        return buffer
+
+    def close(self, universe):
+        # Whatever universe still holds is written, if it was not already.
+        with self.lock:
+            buffer = self.buffers.pop(universe, None)
+        if buffer is not None:
+            buffer.flush()
+
+    def emit(self, universe, verbose, records):
+        if self.format == 'text':
+            prefix = "dbg(u:{},l:{}): " if verbose else ""
+            lines = [prefix.format(universe, line) + _text(kind, expr, value)
+                     for kind, line, expr, value in records]
+        else:
+            lines = [json.dumps({'universe': universe, 'line': line, 'kind': kind, 'expr': str(expr),
+                                 'value': None if value is None else str(value)})
+                     for kind, line, expr, value in records]
+        text = ''.join(line + '\n' for line in lines)
+        with self.lock:
+            (self.file or sys.stderr).write(text)
+
+class DebugCollector(DebugChannel):
+    """
+    Keeps batches as they are, for a worker to send to the channel of its
+    coordinator (see cluster).
+    """
+    def __init__(self, batch=256):
+        super().__init__('text', batch=batch)
+        self.batches = []       # (universe, verbose, records)
+
+    def emit(self, universe, verbose, records):
+        with self.lock:
+            self.batches.append((universe, verbose, records))
+
+def _text(kind, expr, value):
+    if kind == 'unknown':
+        return f"{expr} = unknown"
+    if kind == 'known':
+        return f"now known: {expr} = {value}"
+    text, shown = str(expr), str(value)
+    return shown if text == shown else f"{text} = {shown}"
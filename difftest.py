@@ -0,0 +1,293 @@
+#! /usr/bin/env python
+
+# Differential testing of the engine's modes against the reference.
+#
+#   difftest.py [--seed=<n>] [--count=<n>] [--size=<n>] [<file>...]
+#
+# Each program is run once per mode in MODES, and the outputs of every
+#   universe, the reason and line of every death, and the debug output must
+#   agree with those of the reference mode. Without files, random programs
+#   are generated and checked instead.
+
+import contextlib
+import io
+import random
+import sys
+
+from lexer     import *
+from parser    import *
+from engine    import *
+from optimizer import *
+from analysis  import *
+from cluster   import *
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+# A mode takes reindexed statements and their counts, and returns the
+#   statements to run along with extra keyword arguments for explore (or,
+#   for store, for the Environment).
+
+def reference(statements, count):
+    return statements, {}
+
+def optimized(statements, count):
+    statements = optimize(statements, count)
+    return prune(statements, analyze(statements, count)), {}
+
+def spilled(statements, count):
+    # Keeping a single element in memory sends nearly every read and fork
+    #   through the store.
+    return statements, {'store': SpillStore(statements, keep=1)}
+
+def distributed(statements, count):
+    # Every universe crosses a socket, both ways.
+    return statements, {'coordinator': Coordinator(local=2)}
+
+def merged(statements, count):
+    return statements, {'merge': True}
+
+def learned(statements, count):
+    return statements, {'learn': True}
+
+def lockstepped(statements, count):
+    return statements, {'lockstep': True}
+
+MODES = {
+    'reference':   reference,
+    'optimized':   optimized,
+    'spilled':     spilled,
+    'distributed': distributed,
+    'merged':      merged,
+    'learned':     learned,
+    'lockstepped': lockstepped,
+}
+
+class Recorder(Monitor):
+    def __init__(self):
+        self.deaths = {}
+        self.lock = threading.Lock()
+
+    def finish(self, universe, steps, reason, line):
+        if reason is not None:
+            with self.lock:
+                self.deaths[universe] = (reason, line)
+
+class Outcome:
+    def __init__(self):
+        self.outputs = {}
+        self.deaths = {}
+        self.dbg = []
+        self.error = None
+        self.inconclusive = False
+
+    def differences(self, other):
+        if self.error is not None or other.error is not None:
+            # Tracebacks end up in the debug output, so there is little
+            #   else worth comparing.
+            if self.error != other.error:
+                return [f'error: {self.error} vs {other.error}']
+            return []
+        found = []
+        for universe in sorted(self.outputs.keys() | other.outputs.keys()):
+            mine, theirs = self.outputs.get(universe), other.outputs.get(universe)
+            if mine != theirs:
+                found.append(f'output of {universe}: {mine} vs {theirs}')
+        for universe in sorted(self.deaths.keys() | other.deaths.keys()):
+            mine, theirs = self.deaths.get(universe), other.deaths.get(universe)
+            if mine != theirs:
+                found.append(f'death of {universe}: {mine} vs {theirs}')
+        if self.dbg != other.dbg:
+            found.append('debug output differs')
+        return found
+
+def execute(statements, count, mode):
+    statements, kwargs = MODES[mode](statements, count)
+    store = kwargs.pop('store', None)
+    env = Environment(count, store=store)
+    outcome = Outcome()
+    recorder = Recorder()
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr), store or contextlib.nullcontext():
+        try:
+            outputs, stats = explore(statements, env, monitor=recorder, **kwargs)
+            outcome.outputs = outputs
+            outcome.inconclusive = stats.spawn_limit > 0
+            if stats.errors > 0:
+                outcome.error = f'{stats.errors} universes raised'
+        except Exception as e:
+            outcome.error = f'{type(e).__name__}: {e}'
+    outcome.deaths = recorder.deaths
+    # Universes interleave their debug output, so only the lines themselves
+    #   are compared, not their order.
+    outcome.dbg = sorted(stderr.getvalue().splitlines())
+    return outcome
+
+def check(source):
+    """
+    Returns a list of differences between the reference and the other
+    modes, None if the program could not be compared (it reached the spawn
+    limit, or raised in the reference mode), or a ParseFailure.
+    """
+    statements = parse_program(TokenStream(source))
+    if isinstance(statements, ParseFailure):
+        return statements
+    count = reindex(statements)
+
+    expected = execute(statements, count, 'reference')
+    if expected.inconclusive or expected.error is not None:
+        return None
+    found = []
+    for mode in MODES:
+        if mode == 'reference':
+            continue
+        actual = execute(statements, count, mode)
+        if actual.inconclusive:
+            return None
+        found += [f'{mode}: {d}' for d in expected.differences(actual)]
+    return found
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+class ProgramGenerator:
+    """
+    Generates small well-typed programs. Integers live in a, b and c, and a
+    counter n, bounded by a prophecy, is the only variable revised to a
+    reachable point, so every program terminates well short of MAX_SPAWN.
+    """
+    INTS = ['a', 'b', 'c']
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.assigned = {}      # name -> number of assignments so far
+        self.target = None      # variable being assigned
+
+    def variable(self):
+        choices = [v for v in self.INTS if self.assigned.get(v, 0) > 0] + ['n']
+        name = self.rng.choice(choices)
+        roll = self.rng.random()
+        if roll < 0.15 and name != self.target:
+            # Only refer to the future of other variables: x:+1 on the right
+            #   of an assignment to x is the value being assigned.
+            return f'{name}:+1'
+        if roll < 0.25 and self.assigned.get(name, 0) > 1:
+            return f'{name}:-1'
+        return name
+
+    def int_expr(self, depth=0):
+        roll = self.rng.random()
+        if depth > 2 or roll < 0.3:
+            return str(self.rng.randint(0, 9))
+        if roll < 0.55:
+            return self.variable()
+        if roll < 0.8:
+            op = self.rng.choice(['+', '−', '×', '∧', '∨'])
+            return f'({self.int_expr(depth + 1)} {op} {self.int_expr(depth + 1)})'
+        if roll < 0.85:
+            return f'({self.int_expr(depth + 1)} % 3)'
+        if roll < 0.95:
+            return f'[{self.int_expr(depth + 1)}, {self.int_expr(depth + 1)}].{self.rng.randint(0, 2)}'
+        return f'#[{self.int_expr(depth + 1)}]'
+
+    def bool_expr(self, depth=0):
+        roll = self.rng.random()
+        if depth > 2 or roll < 0.1:
+            return self.rng.choice(['true', 'false'])
+        if roll < 0.6:
+            op = self.rng.choice(['=', '≠', '<', '>', '≤', '≥'])
+            return f'({self.int_expr(depth + 1)} {op} {self.int_expr(depth + 1)})'
+        if roll < 0.75:
+            op = self.rng.choice(['∧', '∨'])
+            return f'({self.bool_expr(depth + 1)} {op} {self.bool_expr(depth + 1)})'
+        if roll < 0.9:
+            return f'!{self.bool_expr(depth + 1)}'
+        return f'~{self.variable()}'
+
+    def statement(self):
+        roll = self.rng.random()
+        if roll < 0.45:
+            name = self.rng.choice(self.INTS)
+            self.target = name
+            line = f'{name} = {self.int_expr()}'
+            self.target = None
+            self.assigned[name] = self.assigned.get(name, 0) + 1
+            return [line]
+        if roll < 0.6:
+            return [f'_:+1 = {self.bool_expr()}', f'_ = {self.rng.choice(["true", "false"])}']
+        if roll < 0.7:
+            return [f'dbg = {self.rng.choice([self.int_expr, self.bool_expr])()}']
+        if roll < 0.85:
+            step = self.rng.choice(['1', '2', f'(1 + ({self.variable()} ∨ 0))'])
+            return [f'n:0 = n + {step}']
+        if roll < 0.9:
+            return [f'{self.rng.choice(self.INTS)}:-7 = {self.int_expr()}']
+        return [f'{self.rng.choice(self.INTS)}:+2 = {self.int_expr()}']
+
+    def program(self, size):
+        self.assigned = {}
+        limit = self.rng.randint(1, 2)
+        lines = ['a = 0', 'b = 1', 'c = 2', 'n = 0', f'_:+1 = n > {limit}', '_ = false']
+        self.assigned = {'a': 1, 'b': 1, 'c': 1}
+        revisions = 0
+        for _ in range(size):
+            block = self.statement()
+            if block[0].startswith('n:0'):
+                # At most two revision sites keep the fork tree small.
+                if revisions == 2:
+                    continue
+                revisions += 1
+            lines += block
+        lines += [f'out = {self.int_expr()}', f'out = {self.bool_expr()}']
+        return '\n'.join(lines) + '\n'
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+def report(name, source, result):
+    if isinstance(result, ParseFailure):
+        print(f'{name}: {result}')
+        return False
+    if result is None:
+        print(f'{name}: \x1B[2minconclusive\x1B[22m')
+        return True
+    if result:
+        print(f'{name}: \x1B[91mmismatch\x1B[39m')
+        for difference in result:
+            print(f'  {difference}')
+        print('\n'.join('  | ' + line for line in source.splitlines()))
+        return False
+    return True
+
+def main(argv):
+    options = {}
+    paths = []
+    for arg in argv:
+        if arg.startswith('--'):
+            flag, _, value = arg.partition('=')
+            options[flag] = value
+        else:
+            paths.append(arg)
+
+    passed = True
+    if paths:
+        for path in paths:
+            with open(path) as fh:
+                source = fh.read()
+            ok = report(path, source, check(source))
+            passed = passed and ok
+            if ok:
+                print(f'{path}: ok')
+        return 0 if passed else 1
+
+    seed = int(options.get('--seed') or 0)
+    count = int(options.get('--count') or 100)
+    size = int(options.get('--size') or 12)
+    rng = random.Random(seed)
+    generator = ProgramGenerator(rng)
+    for k in range(count):
+        source = generator.program(size)
+        ok = report(f'seed {seed}, program {k}', source, check(source))
+        passed = passed and ok
+    print(f'{count} programs, {"all agree" if passed else "mismatches found"}')
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
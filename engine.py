@@ -1,11 +1,22 @@
 from objects import *
+from monitor import *
+from program import *
+import checkpoint
+from spill import *
+from debug import *
+from merge import *
+from nogood import *
+import math
+import random
 import threading
+import time
+import traceback
 import sys
 
 class CodeHistoryElement:
     def __init__(self, line):
-        # varName: currentIndex
-        self.var_history_indexes = {}
+        # slot -> index of the last element of its history, or -1
+        self.var_history_indexes = ()
         self.prophecies = []
         self.pending_forks = []
         self.pending_dbgs = []
@@ -23,100 +34,699 @@ class VarHistoryElement:
         return f"VarHistoryElem<Expression: {self.expression}, Code Index: {self.code_index}>"
 
 class Environment:
-    def __init__(self, var_count, verbose=False):
+    def __init__(self, var_count, verbose=False, store=None):
         # If idx = var_count[var] - 1, then var@idx is the last value of var.
-        # The var_count dict is never mutated.
-        self.var_histories = {}
-        self.code_history = []
+        # The var_count dict is never mutated. Its names are in slot order
+        #   (see reindex), and histories and counts are addressed by slot.
+        # With a SpillStore, histories are SpilledHistories rather than lists.
         self.var_count = var_count
+        self.names = list(var_count)
+        self.counts = list(var_count.values())
+        self.store = store
+        self.var_histories = [self._history() for _ in self.counts]
+        self.code_history = self._history()
         self.verbose = verbose
+        # Universes merged into this one (see Merger), as (name, spawn count
+        #   offset, steps executed before the merge).
+        self.aliases = []
 
-    def fork(self, var_name, var_index, new_value, universe, line_number):
-        if var_name not in self.var_histories or var_index < 0:
+    def _history(self):
+        return [] if self.store is None else SpilledHistory(self.store)
+
+    def __getstate__(self):
+        # A checkpoint outlives the store, and SpilledHistory pickles as a list.
+        return dict(self.__dict__, store=None)
+
+    def fork(self, var_slot, var_index, new_value, universe, line_number):
+        if not self.var_histories[var_slot] or var_index < 0:
             # Signals to caller that fork insta-dies because it's going to an undefined point.
             if self.verbose:
                 sys.stderr.write(f"dbg(u:{universe},l:{line_number}): Fork happens before big-bang, travel will fail.\n")
             return None, None, None
-        assert var_index < len(self.var_histories[var_name]), "Trying to fork to future event."
-        code_index = self.var_histories[var_name][var_index].code_index
+        assert var_index < len(self.var_histories[var_slot]), "Trying to fork to future event."
+        code_index = self.var_histories[var_slot][var_index].code_index
         assert code_index < len(self.code_history)
 
-        new_env = Environment(self.var_count, self.verbose)
+        new_env = Environment(self.var_count, self.verbose, self.store)
         new_env.code_history = self.code_history[:code_index + 1]
         code = self.code_history[code_index]
-        new_env.var_histories = {
-            var: history[:code.var_history_indexes[var] + 1] for var, history in self.var_histories.items() if var in code.var_history_indexes}
-        old_var_history = new_env.var_histories[var_name][var_index]
-        new_env.var_histories[var_name][var_index] = VarHistoryElement(new_value, old_var_history.code_index)
+        new_env.var_histories = [
+            history[:last + 1] for history, last in zip(self.var_histories, code.var_history_indexes)]
+        old_var_history = new_env.var_histories[var_slot][var_index]
+        new_env.var_histories[var_slot][var_index] = VarHistoryElement(new_value, old_var_history.code_index)
         return new_env, code_index, code.line
 
     def __str__(self):
         def str_var_histories(var_histories):
-            return f"{{{",\n   ".join(f"{var}:\t[{",".join(str(elm) for elm in hist)}]" for var, hist in var_histories.items())}}}"
+            return f"{{{",\n   ".join(f"{var}:\t[{",".join(str(elm) for elm in hist)}]" for var, hist in zip(self.names, var_histories) if hist)}}}"
         return f"Environment:\n" + \
             f"Variable Histories:\n  {str_var_histories(self.var_histories)}\n" + \
             f"Code History:\n  [{",\n   ".join(str(elem) for elem in self.code_history)}]"
 
+class OutputGroups:
+    """
+    Collects the outputs of universes as they complete, in place of the
+    dict that explore otherwise fills. Only one copy of each distinct
+    sequence of outputs is kept, with the number of universes that produced
+    it and the first of them in fork order.
+    """
+    def __init__(self, on_new=None):
+        # on_new -- called with each sequence the first time it is produced
+        self.groups = {}    # outputs -> [count, first universe]
+        self.on_new = on_new
+        self.lock = threading.Lock()
+
+    def __setitem__(self, universe, outputs):
+        key = tuple(outputs)
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                self.groups[key] = [1, universe]
+                if self.on_new is not None:
+                    self.on_new(key)
+                return
+            group[0] += 1
+            if universe_order(universe) < universe_order(group[1]):
+                group[1] = universe
+
+    def __len__(self):
+        return len(self.groups)
+
+    def update(self, other):
+        # Folds in the outputs of an earlier part of the same run, which have
+        #   already been reported to on_new if they were going to be.
+        if isinstance(other, OutputGroups):
+            entries = [(first, key, count) for key, (count, first) in other.groups.items()]
+        else:
+            entries = [(universe, tuple(outputs), 1) for universe, outputs in other.items()]
+        with self.lock:
+            for universe, key, count in entries:
+                group = self.groups.setdefault(key, [0, universe])
+                group[0] += count
+                if universe_order(universe) < universe_order(group[1]):
+                    group[1] = universe
+
+    def __getstate__(self):
+        return {'groups': self.groups}
+
+    def __setstate__(self, state):
+        self.groups = state['groups']
+        self.on_new = None
+        self.lock = threading.Lock()
+
+    def sorted(self):
+        # (outputs, count, first universe), in the order of first universes.
+        groups = [(key, count, first) for key, (count, first) in self.groups.items()]
+        return sorted(groups, key=lambda group: universe_order(group[2]))
+
+class Limits:
+    """
+    Bounds on the resources of a run; None leaves one unbounded. A universe
+    that goes over one is killed with the matching reason in LIMITS.
+
+      steps     statements executed by a single universe
+      seconds   wall time of a single universe
+      history   history elements held by a single universe
+      deadline  wall time of the whole run, in seconds
+    """
+    def __init__(self, steps=None, seconds=None, history=None, deadline=None):
+        self.steps = steps
+        self.seconds = seconds
+        self.history = history
+        self.deadline = deadline
+        self.expires = None
+
+    def start(self):
+        if self.deadline is not None:
+            self.expires = time.perf_counter() + self.deadline
+
+    def exceeded(self, steps, born, held):
+        # The reason a universe born at born, having executed steps
+        #   statements and holding held history elements, has to die, if any.
+        if self.steps is not None and steps >= self.steps:
+            return 'step-limit'
+        if self.history is not None and held > self.history:
+            return 'history-limit'
+        if self.seconds is not None or self.expires is not None:
+            now = time.perf_counter()
+            if self.expires is not None and now > self.expires:
+                return 'deadline'
+            if self.seconds is not None and now - born > self.seconds:
+                return 'time-limit'
+        return None
+
+class Scheduler:
+    """
+    Lets a run be checkpointed. Spawned universes start right away, each in
+    a thread of its own, until hold() is called; from then on they are
+    parked instead. Once the universes already running have finished, the
+    run ends and the parked universes, together with the outputs and
+    counters so far, are saved to the checkpoint file. A run given a
+    Scheduler that has resumed a checkpoint starts from the universes
+    parked in it rather than from the root.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.holding = False
+        self.parked = []        # (universe, env, start index)
+        self.resumed = None     # state loaded from a checkpoint
+        self.lock = threading.Lock()
+
+    def hold(self):
+        self.holding = True
+
+    def park(self, universe, env, start_index):
+        with self.lock:
+            self.parked.append((universe, env, start_index))
+
+    def save(self, code, outputs, stats):
+        state = {
+            'parked': self.parked,
+            'outputs': outputs,
+            'total_spawned': total_spawned,
+            'stats': stats.as_dict(),
+        }
+        checkpoint.save(self.path, code.statements, state)
+
+    def resume(self, path, code):
+        statements = code.statements if isinstance(code, Program) else code
+        self.resumed = checkpoint.load(path, statements)
+
 MAX_SPAWN = 10024
 total_spawned = 0
 
-def run(*args, **kwargs):
+def explore(code, env, monitor=None, outputs=None, **kwargs):
+    """
+    Runs every universe to completion. Returns the outputs of each universe
+    that completed, keyed by universe, and the Statistics of the run.
+    outputs, if given, is filled instead of a new dict and returned.
+
+    If a scheduler is given and universes were parked, the run is saved to
+    its checkpoint file instead of completing. If a coordinator is given
+    (see cluster), the universes are run by its workers instead of here.
+    The output of dbg goes to debug, a DebugChannel, as text on stderr by
+    default.
+
+    With merge, universes that reach a statement in states the rest of the
+    program cannot tell apart are merged (see Merger). Merging is left out
+    when universes run on workers or have limits of their own on steps or
+    time, which would tell them apart. With learn, prophecy violations are
+    learned as Nogoods, which prune the universes bound to repeat them;
+    learning is left out on workers and with limits, which could kill a
+    universe before it got to the violation. With lockstep, the children a
+    universe spawns from the same statement run as a batch (see run_batch),
+    except on workers, which run a universe at a time. That only pays off
+    when siblings evaluate the same values; otherwise a batch costs more
+    than running its universes apart.
+    """
     global total_spawned
     total_spawned = 1
+    kwargs.setdefault("debug", DebugChannel())
+    coordinator = kwargs.pop("coordinator", None)
+    merge = kwargs.pop("merge", False)
+    learn = kwargs.pop("learn", False)
+    lockstep = kwargs.pop("lockstep", False)
+    if not isinstance(code, Program):
+        code = compile_program(code, env.var_count, kwargs.get("dbg_name", "dbg"))
+    limits = kwargs.get("limits")
+    if merge and coordinator is None and (limits is None or limits.steps is None and limits.seconds is None):
+        kwargs["merger"] = Merger(code, kwargs.get("out_name", "out"))
+    if learn and coordinator is None and limits is None:
+        kwargs["nogoods"] = Nogoods(code)
+    if lockstep and coordinator is None:
+        kwargs["lockstep"] = True
+    outputs = {} if outputs is None else outputs
+    stats = Statistics()
+    # Workers only send every step back if there is a monitor to see them.
+    steps = monitor is not None and monitor.wants_steps
+    monitor = combine(stats, monitor)
+    scheduler = kwargs.get("scheduler")
+    resumed = scheduler.resumed if scheduler is not None else None
+    if resumed is not None:
+        if isinstance(resumed['outputs'], OutputGroups) and not isinstance(outputs, OutputGroups):
+            raise AssertionError('a checkpoint of grouped outputs can only be resumed with grouped outputs')
+        outputs.update(resumed['outputs'])
+        stats.add(resumed['stats'])
+        total_spawned = resumed['total_spawned']
+    started = time.perf_counter()
+    if kwargs.get("limits") is not None:
+        kwargs["limits"].start()
+    try:
+        if coordinator is not None:
+            pending = resumed['parked'] if resumed is not None else [("root", env, 0)]
+            total_spawned = coordinator.run(code, pending, outputs, monitor, total_spawned,
+                                            steps=steps, **kwargs)
+            stats.peak = max(stats.peak, coordinator.peak)
+        elif resumed is None:
+            run_code_to_completion(code, env, outputs, monitor=monitor, **kwargs)
+        else:
+            threads = []
+            for universe, parked_env, start_index in resumed['parked']:
+                args = (code, parked_env, outputs)
+                thread = threading.Thread(target=run_code_to_completion, args=args,
+                                          kwargs=dict(kwargs, start_index=start_index, universe=universe, monitor=monitor))
+                threads.append(thread)
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        stats.wall_time += time.perf_counter() - started
+        if kwargs.get("nogoods") is not None:
+            stats.pruned += kwargs["nogoods"].pruned
+    if scheduler is not None and scheduler.parked:
+        scheduler.save(code, outputs, stats)
+    return outputs, stats
+
+def replay(code, env, universe, monitor=None, **kwargs):
+    """
+    Re-executes the one universe named, and each universe it descends from
+    only as far as the fork that leads to the next, spawning nothing else.
+    Returns the outputs of the universe, keyed by universe as in explore
+    (so empty unless it completed), and the Statistics of the replay.
+    """
+    global total_spawned
+    total_spawned = 1
+    kwargs.setdefault("debug", DebugChannel())
+    assert universe == "root" or universe.startswith("root-"), f"{universe} is not a universe."
+    if not isinstance(code, Program):
+        code = compile_program(code, env.var_count, kwargs.get("dbg_name", "dbg"))
     outputs = {}
-    run_code_to_completion(*args, outputs, **kwargs)
-    for _, msgs in outputs.items():
-        for msg in msgs:
-            print(msg)
+    stats = Statistics()
+    monitor = combine(stats, monitor)
+    started = time.perf_counter()
+    if kwargs.get("limits") is not None:
+        kwargs["limits"].start()
+    current, start_index = "root", 0
+    try:
+        for number in universe_order(universe) + (-1,):
+            successor = run_code_to_completion(code, env, outputs, start_index=start_index, universe=current,
+                                               monitor=monitor, follow=number, **kwargs)
+            if number == -1:
+                break
+            if successor is None:
+                raise AssertionError(f"{current} never spawned {current}-{number}.")
+            current, env, start_index = successor
+    finally:
+        stats.wall_time += time.perf_counter() - started
+    return outputs, stats
+
+class Estimates:
+    """
+    What sample found: for each distinct sequence of outputs, an estimate of
+    the number of universes of the whole tree that produce it, along with
+    its standard error, over the walks taken so far.
+    """
+    def __init__(self):
+        self.walks = 0
+        self.sums = {}          # outputs -> [sum over walks, sum of squares]
+        self.universes = [0.0, 0.0]
+
+    def add(self, found, universes):
+        # The outcome of a walk: outputs -> the weight it found them with,
+        #   and the weight of every universe on the path.
+        self.walks += 1
+        for key, weight in found.items():
+            sums = self.sums.setdefault(key, [0.0, 0.0])
+            sums[0] += weight
+            sums[1] += weight * weight
+        self.universes[0] += universes
+        self.universes[1] += universes * universes
+
+    def _estimate(self, total, squares):
+        if self.walks == 0:
+            return 0.0, None
+        mean = total / self.walks
+        if self.walks == 1:
+            return mean, None
+        variance = max(0.0, squares / self.walks - mean * mean) * self.walks / (self.walks - 1)
+        return mean, math.sqrt(variance / self.walks)
+
+    def total(self):
+        # Estimated number of universes in the tree, whatever became of them.
+        return self._estimate(*self.universes)
+
+    def sorted(self):
+        # (outputs, estimate, standard error), the most frequent first.
+        found = [(key,) + self._estimate(*sums) for key, sums in self.sums.items()]
+        return sorted(found, key=lambda entry: -entry[1])
+
+def sample(code, env, walks, seed=0, monitor=None, **kwargs):
+    """
+    Estimates the outputs of a fork tree too big to explore from walks
+    random paths down it, each from root to a universe that spawns nothing,
+    the child to go on with picked by random.Random(seed). A universe on a
+    path stands for as many universes as the product of the numbers of
+    children along the way there, which makes the estimates unbiased; each
+    is run once, however many walks pass through it, with its children
+    parked. A deadline in limits ends the walks early. Returns the Estimates
+    and the Statistics of the universes run.
+    """
+    global total_spawned
+    kwargs.setdefault("debug", DebugChannel())
+    if not isinstance(code, Program):
+        code = compile_program(code, env.var_count, kwargs.get("dbg_name", "dbg"))
+    rng = random.Random(seed)
+    estimates = Estimates()
+    stats = Statistics()
+    monitor = combine(stats, monitor)
+    limits = kwargs.get("limits")
+    tree = {}                   # universe -> (its outputs or None, its children)
+    unborn = {"root": (env, 0)} # universe -> (env, start index), until it is run
+    started = time.perf_counter()
+    if limits is not None:
+        limits.start()
+    try:
+        for _ in range(walks):
+            if limits is not None and limits.expires is not None and time.perf_counter() > limits.expires:
+                break
+            universe, weight = "root", 1
+            found = {}
+            universes = 0
+            while True:
+                if universe not in tree:
+                    # The spawn limit is for exploring, not for a single universe.
+                    total_spawned = 1
+                    scheduler = Scheduler(None)
+                    scheduler.hold()
+                    outputs = {}
+                    universe_env, start_index = unborn.pop(universe)
+                    try:
+                        run_code_to_completion(code, universe_env, outputs, start_index=start_index, universe=universe,
+                                               monitor=monitor, scheduler=scheduler, **kwargs)
+                    except Exception:
+                        traceback.print_exc()
+                    for child, child_env, child_start in scheduler.parked:
+                        unborn[child] = (child_env, child_start)
+                    tree[universe] = (outputs.get(universe), [child for child, _, _ in scheduler.parked])
+                msgs, children = tree[universe]
+                universes += weight
+                if msgs is not None:
+                    found[tuple(msgs)] = found.get(tuple(msgs), 0) + weight
+                if not children:
+                    break
+                universe = rng.choice(children)
+                weight *= len(children)
+            estimates.add(found, universes)
+    finally:
+        stats.wall_time += time.perf_counter() - started
+    return estimates, stats
+
+OUTPUT_MODES = ['all', 'grouped', 'distinct']
+
+def run(code, env, output='all', **kwargs):
+    """
+    Like explore, but prints the outputs and returns only the Statistics.
+    output is one of OUTPUT_MODES:
+
+      all       the outputs of every universe, one universe after another
+      grouped   each distinct sequence of outputs once, headed by the number
+                of universes that produced it and the first of them
+      distinct  each distinct sequence of outputs once, printed as soon as
+                some universe completes with it
+    """
+    # A run that ended in a checkpoint is not over, so its outputs are only
+    #   printed once it is resumed and completes.
+    scheduler = kwargs.get("scheduler")
+    if output == 'all':
+        outputs, stats = explore(code, env, **kwargs)
+        if scheduler is not None and scheduler.parked:
+            return stats
+        for _, msgs in outputs.items():
+            for msg in msgs:
+                print(msg)
+    elif output == 'grouped':
+        groups = OutputGroups()
+        _, stats = explore(code, env, outputs=groups, **kwargs)
+        if scheduler is not None and scheduler.parked:
+            return stats
+        for msgs, count, first in groups.sorted():
+            print(f"{count} × {first}:")
+            for msg in msgs:
+                print(f"  {msg}")
+    elif output == 'distinct':
+        def show(msgs):
+            for msg in msgs:
+                print(msg)
+            sys.stdout.flush()
+        _, stats = explore(code, env, outputs=OutputGroups(show), **kwargs)
+    else:
+        raise AssertionError(f'unknown output mode "{output}"')
+    return stats
+
+def _failed(env, kwargs):
+    # What run_code would have done had the universe not raised.
+    names = [kwargs.get("universe", "root")] + [alias for alias, _, _ in env.aliases]
+    for name in names:
+        if kwargs.get("debug") is not None:
+            kwargs["debug"].close(name)
+        monitor = kwargs.get("monitor")
+        if monitor is not None:
+            monitor.finish(name, None, 'error', None)
 
 def run_code_to_completion(*args, **kwargs):
     threads = []
     try:
-        run_code(*args, spawned_threads=threads, **kwargs)
+        return run_code(*args, spawned_threads=threads, **kwargs)
+    except Exception:
+        _failed(args[1], kwargs)
+        raise
     finally:
         for thread in threads:
             thread.join()
 
-def run_code(code, env, universe_outputs, spawned_threads, start_index=0, universe="root", out_name="out", dbg_name="dbg"):
-    global total_spawned
+class Batch:
+    """
+    The statement a batch of universes running in lockstep (see run_batch)
+    is at, and the values its right-hand side took for each of them. Where
+    every event it reads holds a value, it is only evaluated once for all
+    the universes of the batch that read the same values.
+    """
+    def __init__(self, code):
+        self.exprs = code.exprs
+        self.reads = [sorted(events_read(expr)) for expr in code.exprs]
+        self.pc = None
+        self.values = {}        # ids of the values read -> (values, value)
+
+    def eval(self, pc, env):
+        if pc != self.pc:
+            self.pc = pc
+            self.values = {}
+        # Values are interned, so the same values are (nearly always) the
+        #   same objects; they are kept along with what was evaluated, for
+        #   their ids to stay theirs.
+        objects = []
+        for slot, index in self.reads[pc]:
+            history = env.var_histories[slot]
+            value = history[index].expression if index < len(history) else None
+            if not (value is None or value is UNDEFINED or isinstance(value, Literal)
+                    or isinstance(value, Tuple) and value.concrete):
+                # Left unevaluated, so it depends on more than it reads.
+                return self.exprs[pc].eval(env)
+            objects.append(value)
+        key = tuple(id(value) for value in objects)
+        found = self.values.get(key)
+        if found is None:
+            found = self.values[key] = (objects, self.exprs[pc].eval(env))
+        return found[1]
 
+def run_batch(code, members, universe_outputs, **kwargs):
+    """
+    Runs members, universes given as (universe, env, start index) that all
+    start at the same statement, in lockstep in the current thread: each
+    runs a statement in turn, sharing what it evaluates with the others
+    through a Batch, until it stops. The keyword arguments are those of
+    run_code.
+    """
+    batch = Batch(code)
+    threads = []
+    running = []
+    for universe, env, start_index in members:
+        member_kwargs = dict(kwargs, start_index=start_index, universe=universe)
+        steps = universe_steps(code, env, universe_outputs, threads, batch=batch, **member_kwargs)
+        running.append((env, steps, member_kwargs))
+    try:
+        while running:
+            for member in list(running):
+                env, steps, member_kwargs = member
+                try:
+                    next(steps)
+                except StopIteration:
+                    running.remove(member)
+                except Exception:
+                    traceback.print_exc()
+                    _failed(env, member_kwargs)
+                    running.remove(member)
+    finally:
+        for thread in threads:
+            thread.join()
+
+def run_code(*args, **kwargs):
+    """
+    Runs a universe (see universe_steps) to its end, and returns what it
+    returns.
+    """
+    steps = universe_steps(*args, **kwargs)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+def universe_steps(code, env, universe_outputs, spawned_threads, start_index=0, universe="root", out_name="out", dbg_name="dbg", monitor=None, limits=None, scheduler=None, follow=None, debug=None, merger=None, nogoods=None, lockstep=False, batch=None):
+    # Runs a universe. In a batch it yields after each statement, for the
+    #   others to run theirs; otherwise it runs to its end without yielding,
+    #   so that lockstep costs nothing to the universes that do not use it.
+    #
+    # follow -- in a replay, the number of the one child to spawn, or -1 for
+    #   none. The universe then stops as soon as the child is spawned and
+    #   returns (child, its env, its start index) for the caller to go on with.
+    # merger -- a Merger, to have universes that cannot be told apart merged.
+    #   Whatever can be seen of a universe from then on -- its children, dbg
+    #   records, outputs and death -- is repeated for each of its aliases.
+    # nogoods -- Nogoods, to learn from prophecy violations and be pruned by.
+    # lockstep -- whether the children spawned from the same point are run
+    #   in lockstep, as a batch (see run_batch).
+    # batch -- the Batch of this universe, if it runs in one.
     spawn_count = 0
+    steps = 0
+    born = time.perf_counter()
+    successor = None
+    resolved = False            # whether the last step resolved anything pending
+    dbg_out = debug.open(universe, env.verbose) if debug is not None else None
+    dbg_outs = {}               # alias -> its DebugBuffer
+    newborn = []                # children held back, for the merger or to be batched
+
+    def aliases():
+        return merger.settle(universe, env) if merger is not None else env.aliases
+
+    def record(kind, line, expr, value=None):
+        dbg_out.append(kind, line, expr, value)
+        for alias, _, _ in aliases():
+            if alias not in dbg_outs:
+                dbg_outs[alias] = debug.open(alias, env.verbose)
+            dbg_outs[alias].append(kind, line, expr, value)
+
+    def start(children):
+        # Children spawned from the same point, which run as a batch if
+        #   there are several.
+        if scheduler is not None and scheduler.holding:
+            for child in children:
+                scheduler.park(*child)
+            return
+        kwargs = {"out_name": out_name, "dbg_name": dbg_name, "monitor": monitor, "limits": limits,
+                  "scheduler": scheduler, "debug": debug, "merger": merger, "nogoods": nogoods, "lockstep": lockstep}
+        if len(children) == 1:
+            child, new_env, start_index = children[0]
+            thread = threading.Thread(target=run_code_to_completion, args=(code, new_env, universe_outputs),
+                                      kwargs=dict(kwargs, start_index=start_index, universe=child))
+        else:
+            thread = threading.Thread(target=run_batch, args=(code, children, universe_outputs), kwargs=kwargs)
+        spawned_threads.append(thread)
+        thread.start()
+
+    def close():
+        if dbg_out is not None:
+            dbg_out.close()
+        for buffer in dbg_outs.values():
+            buffer.close()
+        if newborn:
+            kept = newborn
+            if merger is not None:
+                kept, merged = merger.gather(newborn)
+                for child, into in merged:
+                    if monitor is not None:
+                        monitor.merge(child, into)
+            if lockstep:
+                batches = {}
+                for child in kept:
+                    batches.setdefault(child[2], []).append(child)
+                for children in batches.values():
+                    start(children)
+            else:
+                for child in kept:
+                    start([child])
+
+    def finish(reason=None, line=None):
+        names = aliases()
+        close()
+        if monitor is not None:
+            monitor.finish(universe, steps, reason, line)
+            for alias, _, done in names:
+                monitor.finish(alias, done, reason, line)
+
+    def spawn(fork, fork_value):
+        nonlocal spawn_count, successor
+        global total_spawned
+
+        new_env, code_index, fork_line = env.fork(fork.left.slot, fork.left.index, fork_value, universe, fork.line)
+
+        names = aliases()
+
+        # Premature death of fork if `new_env` is None.
+        if new_env is None:
+            if monitor is not None:
+                monitor.abort(universe, fork, 'big-bang')
+                for alias, _, _ in names:
+                    monitor.abort(alias, fork, 'big-bang')
+            return
+        if total_spawned >= MAX_SPAWN:
+            print('spawn limit reached', file=sys.stderr)
+            if monitor is not None:
+                monitor.abort(universe, fork, 'spawn-limit')
+                for alias, _, _ in names:
+                    monitor.abort(alias, fork, 'spawn-limit')
+            return
+
+        child = f"{universe}-{spawn_count}"
+        # The child of each alias is an alias of the child.
+        new_env.aliases = [(f"{alias}-{spawn_count + offset}", 0, 0) for alias, offset, _ in names]
+        if follow is not None and spawn_count != follow:
+            spawn_count += 1
+            return
+        if env.verbose:
+            sys.stderr.write(f"dbg(u:{universe},l:{fork.line}): Forking to {child} at line {fork_line}, {fork.left.name}@{fork.left.index} = {fork_value}\n")
+        if monitor is not None:
+            copied = len(new_env.code_history) + sum(len(h) for h in new_env.var_histories)
+            monitor.spawn(universe, child, fork, fork_line, copied, fork_value)
+            for (alias, _, _), (alias_child, _, _) in zip(names, new_env.aliases):
+                monitor.spawn(alias, alias_child, fork, fork_line, copied, fork_value)
+        if follow is not None:
+            successor = (child, new_env, code_index+1)
+        elif merger is not None or lockstep:
+            newborn.append((child, new_env, code_index+1))
+        else:
+            start([(child, new_env, code_index+1)])
+        spawn_count += 1
+        total_spawned += 1 + len(names)
+
     def resolve_prophecies_and_pending_forks(prev_code, next_code):
+        nonlocal resolved
+        resolved = False
         # Copy prophecies, but also try to resolve them.
         for prophecy in prev_code.prophecies:
             var, expression, line = prophecy
             prophecy_value = expression.eval(env)
-            if prophecy_value is not None and var.name in env.var_histories and len(env.var_histories[var.name]) > var.index:
-                future_value = env.var_histories[var.name][var.index].expression.eval(env)
+            if prophecy_value is not None and len(env.var_histories[var.slot]) > var.index:
+                future_value = env.var_histories[var.slot][var.index].expression.eval(env)
                 if future_value is not None:
                     if future_value != prophecy_value:
                         if env.verbose:
                             sys.stderr.write(f"dbg(u:{universe},l:{line}): Prophecy violated: ({var.name}@{var.index} = {future_value}) ≠ {prophecy_value}\n")
-                        return False
+                        if nogoods is not None:
+                            nogoods.learn(universe, env, len(env.code_history), var)
+                        return line
+                    resolved = True
                     continue
             if next_code is not None:
                 next_code.prophecies.append((var, prophecy_value or expression, line))
+                resolved = resolved or next_code.prophecies[-1][1] is not expression
 
         # Check if any pending forks can be executed, or copy forward to try later.
         for fork in prev_code.pending_forks:
             fork_value = fork.right.eval(env)
             if fork_value is not None:
-                new_env, code_index, fork_line = env.fork(fork.left.name, fork.left.index, fork_value, universe, fork.line)
-
-                # Premature death of fork if `new_env` is None.
-                if new_env is not None:
-                    if total_spawned >= MAX_SPAWN:
-                        print('spawn limit reached', file=sys.stderr)
-                    else:
-                        args = (code, new_env, universe_outputs)
-                        kwargs = {"start_index": code_index+1, "universe": f"{universe}-{spawn_count}", "out_name": out_name, "dbg_name": dbg_name}
-                        thread = threading.Thread(target=run_code_to_completion, args=args, kwargs=kwargs)
-                        if env.verbose:
-                            sys.stderr.write(f"dbg(u:{universe},l:{fork.line}): Forking to {universe}-{spawn_count} at line {fork_line}, {fork.left.name}@{fork.left.index} = {fork_value}\n")
-                        spawned_threads.append(thread)
-                        thread.start()
-                        spawn_count += 1
-                        total_spawned += 1
+                spawn(fork, fork_value)
+                resolved = True
             elif next_code is not None:
                 next_code.pending_forks.append(fork)
 
@@ -128,93 +738,139 @@ def run_code(code, env, universe_outputs, spawned_threads, start_index=0, univer
                 if next_code is not None:
                     next_code.pending_dbgs.append(dbg)
             else:
-                prefix = f"dbg(u:{universe},l:{dbg[0]}): " if env.verbose else ""
-                sys.stderr.write(f"{prefix}now known: {str(dbg[1])} = {str(val)}\n")
+                record('known', dbg[0], dbg[1], val)
+                resolved = True
+
+        return None
+
+    if monitor is not None:
+        monitor.start(universe)
+        for alias, _, _ in env.aliases:
+            monitor.start(alias)
+
+    if nogoods is not None:
+        conflict = nogoods.conflict(env, start_index)
+        if conflict is not None:
+            line, learned = conflict
+            if env.verbose:
+                sys.stderr.write(f"dbg(u:{universe},l:{line}): Pruned, bound to violate the prophecy {learned} did.\n")
+            return finish('prophecy', line)
+
+    statements, ops, slots, indexes = code.statements, code.ops, code.slots, code.indexes
+    exprs, values, constants, lines = code.exprs, code.values, code.constants, code.lines
+    histories = env.var_histories
+    held = len(env.code_history) + sum(len(h) for h in histories)
+    timed = monitor is not None and monitor.wants_steps
+
+    for pc in range(start_index, len(ops)):
+        if limits is not None:
+            exceeded = limits.exceeded(steps, born, held)
+            if exceeded is not None:
+                if env.verbose:
+                    sys.stderr.write(f"dbg(u:{universe},l:{lines[pc]}): Universe killed by {exceeded}.\n")
+                return finish(exceeded, lines[pc])
+
+        if merger is not None and (pc == start_index or resolved or pc in merger.points):
+            host = merger.visit(universe, env, pc, spawn_count, steps)
+            if host is not None:
+                if env.verbose:
+                    sys.stderr.write(f"dbg(u:{universe},l:{lines[pc]}): Merged into {host}.\n")
+                close()
+                if monitor is not None:
+                    monitor.merge(universe, host)
+                return
 
-        return True
+        if timed:
+            started = time.perf_counter()
 
-    for i, stmt in enumerate(code[start_index:]):
-        next_code_history = CodeHistoryElement(stmt.line)
+        next_code_history = CodeHistoryElement(lines[pc])
 
         # Important that pending forks and prophecies get resolved before
         # executing the stmt, otherwise a fork that breaks a prophecy would not
         # get caught.
         if len(env.code_history) != 0:
-            if not resolve_prophecies_and_pending_forks(env.code_history[-1], next_code_history):
-                return
+            violated = resolve_prophecies_and_pending_forks(env.code_history[-1], next_code_history)
+            if violated is not None:
+                return finish('prophecy', violated)
 
-        match stmt.kind:
-            case Assignment.MUTATION:
-                assert (stmt.left.name not in env.var_histories and stmt.left.index == 0) or \
-                    (stmt.left.name in env.var_histories and len(env.var_histories[stmt.left.name]) == stmt.left.index), \
-                    "Mutation to event in wrong timeline position."
-
-                val = stmt.right.eval(env)
-                if stmt.left.name == dbg_name:
-                    prefix = f"dbg(u:{universe},l:{stmt.line}): " if env.verbose else ""
-                    if val is None:
-                        next_code_history.pending_dbgs.append((stmt.line, stmt.right))
-                        sys.stderr.write(f"{prefix}{str(stmt.right)} = unknown\n")
-                    else:
-                        output = str(val) if str(stmt.right) == str(val) else f"{str(stmt.right)} = {str(val)}"
-                        sys.stderr.write(f"{prefix}{output}\n")
-
-                if val is not None and not val.defined(env):
-                    val = None
-                if stmt.left.index == 0:
-                    env.var_histories[stmt.left.name] = [VarHistoryElement(val or stmt.right, len(env.code_history))]
-                else:
-                    # Try to eval lhs. If it can't be evaluated then just take it as is.
-                    env.var_histories[stmt.left.name].append(VarHistoryElement(val or stmt.right, i+start_index))
-            case Assignment.REVISION:
-                assert stmt.left.index < len(env.var_histories[stmt.left.name]), "Revision to event in the future."
-
-                fork_value = stmt.right.eval(env)
-                if fork_value is None:
-                    next_code_history.pending_forks.append(stmt)
+        op = ops[pc]
+        history = histories[slots[pc]]
+        index = indexes[pc]
+        if op == MUTATE or op == DEBUG:
+            assert len(history) == index, "Mutation to event in wrong timeline position."
+
+            val = constants[values[pc]] if values[pc] >= 0 else exprs[pc].eval(env) if batch is None else batch.eval(pc, env)
+            if op == DEBUG and dbg_out is not None:
+                if val is None:
+                    next_code_history.pending_dbgs.append((lines[pc], exprs[pc]))
+                    record('unknown', lines[pc], exprs[pc])
                 else:
-                    new_env, code_index, fork_line = env.fork(stmt.left.name, stmt.left.index, stmt.right.eval(env), universe, stmt.line)
-
-                    # Premature death of fork if `new_env` is None.
-                    if new_env is not None:
-                        if total_spawned >= MAX_SPAWN:
-                            print('spawn limit reached', file=sys.stderr)
-                        else:
-                            args = (code, new_env, universe_outputs)
-                            kwargs = {"start_index": code_index+1, "universe": f"{universe}-{spawn_count}", "out_name": out_name, "dbg_name": dbg_name}
-                            if env.verbose:
-                                sys.stderr.write(f"dbg(u:{universe},l:{stmt.line}): Forking to {universe}-{spawn_count} at line {fork_line}, {stmt.left.name}@{stmt.left.index} = {fork_value}\n")
-                            spawned_threads.append(threading.Thread(target=run_code_to_completion, args=args, kwargs=kwargs))
-                            spawned_threads[-1].start()
-                            spawn_count += 1
-                            total_spawned += 1
-            case Assignment.PROPHECY:
-                assert stmt.left.name not in env.var_histories or len(env.var_histories[stmt.left.name]) <= stmt.left.index, \
-                    "Prophecy about event in the past."
-                next_code_history.prophecies.append((stmt.left, stmt.right.eval(env) or stmt.right, stmt.line))
-            case _:
-                assert False, "Invalid stmt kind."
+                    record('value', lines[pc], exprs[pc], val)
+
+            if val is not None and not val.defined(env):
+                val = None
+            # Try to eval lhs. If it can't be evaluated then just take it as is.
+            #   Statement pc is always the pc-th element of the code history.
+            history.append(VarHistoryElement(val or exprs[pc], pc))
+            if env.store is not None:
+                history.spill()
+            held += 1
+        elif op == REVISE:
+            assert index < len(history), "Revision to event in the future."
+
+            fork_value = constants[values[pc]] if values[pc] >= 0 else exprs[pc].eval(env) if batch is None else batch.eval(pc, env)
+            if fork_value is None:
+                next_code_history.pending_forks.append(statements[pc])
+            else:
+                spawn(statements[pc], fork_value)
+        elif op == PROPHESY:
+            assert len(history) <= index, "Prophecy about event in the past."
+            value = constants[values[pc]] if values[pc] >= 0 else exprs[pc].eval(env) if batch is None else batch.eval(pc, env)
+            next_code_history.prophecies.append((statements[pc].left, value or exprs[pc], lines[pc]))
+        else:
+            assert False, "Invalid opcode."
 
         # Now go and store all the current indexes
-        for var in env.var_histories:
-            next_code_history.var_history_indexes[var] = len(env.var_histories[var]) - 1
+        next_code_history.var_history_indexes = tuple(len(h) - 1 for h in histories)
         env.code_history.append(next_code_history)
+        if env.store is not None:
+            env.code_history.spill()
+        held += 1
+
+        steps += 1
+        if timed:
+            monitor.step(universe, statements[pc], time.perf_counter() - started)
+        if successor is not None:
+            finish('replayed', lines[pc])
+            return successor
+        if batch is not None:
+            yield
 
     # Try one more time to resolve prophecies and pending forks.
     if len(env.code_history) != 0:
-        if not resolve_prophecies_and_pending_forks(env.code_history[-1], None):
-            return
+        violated = resolve_prophecies_and_pending_forks(env.code_history[-1], None)
+        if violated is not None:
+            return finish('prophecy', violated)
+        if successor is not None:
+            finish('replayed', lines[-1])
+            return successor
 
     # TODO: if something in the output is indeterminate, fail this universe.
-    if out_name in env.var_histories:
-        outputs = [out.expression.eval(env) for out in env.var_histories[out_name]]
+    out_history = histories[code.slot_of[out_name]] if out_name in code.slot_of else []
+    if out_history:
+        outputs = [out.expression.eval(env) for out in out_history]
         for i, output in enumerate(outputs):
             if output is None or not output.defined(env):
-                out = env.var_histories[out_name][i]
+                out = out_history[i]
                 if env.verbose:
-                    sys.stderr.write(f"dbg(u:{universe},l:{stmt.line+1}): Indeterminate output at line {env.code_history[out.code_index].line}: {out.expression}, universe {universe} failed.\n")
-                return
-        universe_outputs[universe] = [str(out) for out in outputs]
+                    sys.stderr.write(f"dbg(u:{universe},l:{lines[-1]+1}): Indeterminate output at line {env.code_history[out.code_index].line}: {out.expression}, universe {universe} failed.\n")
+                return finish('indeterminate', env.code_history[out.code_index].line)
+        msgs = [str(out) for out in outputs]
+        universe_outputs[universe] = msgs
+        for alias, _, _ in aliases():
+            universe_outputs[alias] = msgs
+
+    finish()
 
 if __name__ == "__main__":
     # x = 1
@@ -251,7 +907,12 @@ if __name__ == "__main__":
     ]
     output={}
     var_count = {"x": 2, "y": 1, "z": 1, "out": 2, "dbg": 5}
-    run_code_to_completion(code, Environment(var_count), output)
+    # What reindex would have done.
+    for assn in code:
+        for var in (assn.left, assn.right):
+            if isinstance(var, Variable):
+                var.slot = list(var_count).index(var.name)
+    run_code_to_completion(compile_program(code, var_count), Environment(var_count), output)
     for _, outputs in output.items():
         for out in outputs:
             print(out)
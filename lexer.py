@@ -1,3 +1,5 @@
+import array
+import mmap
 import re
 
 COMMENT = ['//', '--', '\u203B']
@@ -142,22 +144,114 @@ class ParseFailure:
 
 #~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
 
+class Source:
+    """
+    The text of a program file, memory-mapped instead of read, to be fed to a
+    TokenStream a chunk at a time (see read). As a sequence, it is the lines
+    of the whole file, found through an index of where each starts, which is
+    built the first time a line is asked for.
+    """
+    def __init__(self, path, chunk=1 << 14, encoding='utf-8', start=0, end=None, data=None):
+        """
+        path       -- file to read
+        data       -- its bytes, if they were read already
+        chunk      -- size in bytes of the chunks read returns, give or take
+                      a line
+        start, end -- range of bytes read goes through, starting at the
+                      start of a line; the whole file by default
+        """
+        self.path     = path
+        self.chunk    = chunk
+        self.encoding = encoding
+        self.offset   = start
+        self.end      = end
+        self.starts   = None
+        if data is not None:
+            self.data = data
+        else:
+            with open(path, 'rb') as fh:
+                try:
+                    self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty files cannot be mapped.
+                    self.data = b''
+        if self.end is None:
+            self.end = len(self.data)
+
+    def read(self):
+        """
+        Returns the next chunk of text, which ends at the end of a line, or
+        None at the end of the file.
+        """
+        if self.offset >= self.end:
+            return None
+        end = self.data.find(b'\n', self.offset + self.chunk, self.end)
+        end = self.end if end < 0 else end + 1
+        chunk = self.data[self.offset:end]
+        self.offset = end
+        return _newlines(chunk.decode(self.encoding))
+
+    def _index(self):
+        if self.starts is None:
+            self.starts = array.array('q', [0])
+            self.starts.extend(match.end() for match in re.finditer(b'\n', self.data))
+        return self.starts
+
+    def __len__(self):
+        return len(self._index())
+
+    def __getitem__(self, idx):
+        starts = self._index()
+        if idx < 0:
+            idx += len(starts)
+        if not 0 <= idx < len(starts):
+            raise IndexError()
+        end = starts[idx + 1] - 1 if idx + 1 < len(starts) else len(self.data)
+        return _newlines(self.data[starts[idx]:end].decode(self.encoding)).rstrip('\n')
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _newlines(text):
+    # What reading the file as text would give.
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
 class TokenStream:
-    def __init__(self, text, more=None):
+    def __init__(self, text, more=None, lines=None):
         """
-        text -- text to be tokenized
-        more -- nullary function that will be called to get more text
+        text  -- text to be tokenized
+        more  -- nullary function that will be called to get more text
+        lines -- the whole text as a sequence of lines, if it is kept
+                 elsewhere (see Source); the stream then keeps neither the
+                 text nor the tokens it has read, and cannot be indexed
         """
         self.text     = text
         self.more     = more
         self.line     = 1
         self.column   = 1
         self.newline  = False
-        self.buffer   = []
-        self._log     = [text]
+        self.lines    = lines
+        self.buffer   = [] if lines is None else _Discard()
+        self._log     = [text] if lines is None else _Discard()
         self.complete = False
 
+    @classmethod
+    def of(cls, source, line=1):
+        # A stream of the text of a Source, which starts on line.
+        stream = cls('', source.read, source)
+        stream.line = line
+        return stream
+
     def log(self):
+        if self.lines is not None:
+            return self.lines
         return ''.join(self._log).split('\n')
 
     def _advance(self, string):
@@ -358,6 +452,7 @@ class TokenStream:
         return len(self.buffer)
 
     def __getitem__(self, idx):
+        assert self.lines is None, 'a stream that keeps no tokens cannot be indexed'
         if idx < 0:
             raise IndexError()
         if not idx < len(self.buffer):
@@ -369,6 +464,14 @@ class TokenStream:
                     break
         return self.buffer[idx]
 
+class _Discard:
+    # Stands in for a list whose elements are not kept.
+    def append(self, item):
+        pass
+
+    def __len__(self):
+        return 0
+
 #~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+import bisect
+import threading
+
+from objects import *
+from program import *
+
+# Merging universes. Two universes at the same statement whose states agree on
+#   everything the rest of the program can still observe go on to do the same
+#   things, so one of them can go on for both: it carries the names of the
+#   others as aliases, and its outputs, deaths, dbg records and children are
+#   credited to every one of them (see run_code).
+#
+# What the rest of the program can observe is worked out once, from the
+#   program alone. An event x@i is live at statement pc if a statement that
+#   may still run reads it -- counting those a fork from pc on can go back
+#   to, however far -- or if it is read by a prophecy or dbg that may still
+#   be pending, is an output, or went into an event that is live itself.
+#   Universes must also agree on what is pending in the code history
+#   elements a fork can resume from. Values are interned and program nodes
+#   shared, so agreeing means holding the very same objects; the rare equal
+#   values that are not (see Literal) only cost a merge.
+
+def events_read(expr, found=None):
+    # (slot, index) of every event expr refers to.
+    found = set() if found is None else found
+    if isinstance(expr, Variable):
+        if expr.index >= 0:
+            found.add((expr.slot, expr.index))
+    elif isinstance(expr, Tuple) and not expr.concrete:
+        for elem in expr.elements:
+            events_read(elem, found)
+    elif isinstance(expr, UnaryExpression):
+        events_read(expr.operand, found)
+    elif isinstance(expr, BinaryExpression):
+        events_read(expr.left, found)
+        events_read(expr.right, found)
+    return found
+
+class Merger:
+    """
+    The universes of a run that others could be merged into. A universe is
+    only compared with the others where it may have become like one of them:
+    where it starts, where events stop being live, and after something
+    pending was resolved. Since a universe can no longer be merged into once
+    it has done anything that can be seen, the children of a universe are
+    held back until it stops, and merged among themselves first (see
+    gather).
+    """
+    def __init__(self, code, out_name="out"):
+        n = len(code)
+        ops, slots, indexes = code.ops, code.slots, code.indexes
+        defs = {}       # (slot, index) -> statement that appends it
+        for pc in range(n):
+            if ops[pc] == MUTATE or ops[pc] == DEBUG:
+                defs[(slots[pc], indexes[pc])] = pc
+        reads = [events_read(expr) for expr in code.exprs]
+
+        # A fork by revision r resumes right after the statement that appended
+        #   the event it revises. earliest[pc] is the first statement a
+        #   universe at pc, or any universe forked from it, can run again.
+        self.resumes = {}
+        for pc in range(n):
+            if ops[pc] == REVISE and (slots[pc], indexes[pc]) in defs:
+                self.resumes[pc] = defs[(slots[pc], indexes[pc])] + 1
+        reach = [n] * (n + 1)
+        for pc in reversed(range(n)):
+            reach[pc] = min(reach[pc + 1], self.resumes.get(pc, n))
+        self.earliest = []
+        for pc in range(n):
+            m = pc
+            while reach[m] < m:
+                m = reach[m]
+            self.earliest.append(m)
+
+        # last[e] -- the last statement whose running still makes e live,
+        #   or n if it is always live.
+        last = {e: -1 for e in defs}
+        for pc in range(n):
+            for e in reads[pc]:
+                if e in last:
+                    last[e] = max(last[e], pc)
+        for pc in range(n):
+            if ops[pc] == PROPHESY or ops[pc] == DEBUG:
+                for e in reads[pc] | {(slots[pc], indexes[pc])}:
+                    if e in last:
+                        last[e] = n
+        if out_name in code.slot_of:
+            for e in last:
+                if e[0] == code.slot_of[out_name]:
+                    last[e] = n
+        # Reading an event left unevaluated evaluates what it was assigned.
+        ordered = sorted(defs, key=defs.get, reverse=True)
+        changed = True
+        while changed:
+            changed = False
+            for f in ordered:
+                for e in reads[defs[f]]:
+                    if e in last and last[e] < last[f]:
+                        last[e] = last[f]
+                        changed = True
+
+        self.events = sorted(defs, key=defs.get)
+        self.defined = [defs[e] for e in self.events]
+        self.last = last
+        self.points = set()
+        for e, pc in defs.items():
+            dies = bisect.bisect_right(self.earliest, last[e])
+            if pc < dies - 1 < n - 1:
+                self.points.add(dies)
+        for r, resume in self.resumes.items():
+            dies = bisect.bisect_right(self.earliest, r)
+            if resume < dies < n:
+                self.points.add(dies)
+        self.plans = {}         # pc -> (live events, code history elements)
+        self.hosts = {}         # key -> (universe, env, spawn count, objects)
+        self.keys = {}          # universe -> keys it is host for
+        self.lock = threading.Lock()
+
+    def _plan(self, pc):
+        plan = self.plans.get(pc)
+        if plan is None:
+            m = self.earliest[pc]
+            existing = self.events[:bisect.bisect_left(self.defined, pc)]
+            live = tuple(e for e in existing if self.last[e] >= m)
+            elems = {resume - 1 for r, resume in self.resumes.items() if r >= m and resume <= pc}
+            if pc > 0:
+                elems.add(pc - 1)
+            plan = self.plans[pc] = (live, tuple(sorted(elems)))
+        return plan
+
+    def key(self, pc, env):
+        # What universes at pc must agree on to be merged, or None if env
+        #   has a fork pending, which could take it anywhere. The objects are
+        #   returned along with it, since the key only holds their ids.
+        live, elems = self._plan(pc)
+        objects = [env.var_histories[slot][index].expression for slot, index in live]
+        for c in elems:
+            elem = env.code_history[c]
+            if elem.pending_forks:
+                return None, None
+            for var, value, _ in elem.prophecies:
+                objects += (var, value)
+            objects.append(None)
+            objects += [expr for _, expr in elem.pending_dbgs]
+            objects.append(None)
+        return (pc,) + tuple(id(obj) for obj in objects), objects
+
+    def visit(self, universe, env, pc, spawn_count, steps):
+        """
+        Called by a universe about to run statement pc. Returns the universe
+        it was merged into, having handed its aliases over, or None if it
+        goes on itself.
+        """
+        key, objects = self.key(pc, env)
+        if key is None:
+            return None
+        with self.lock:
+            host = self.hosts.get(key)
+            if host is None:
+                self.hosts[key] = (universe, env, spawn_count, objects)
+                self.keys.setdefault(universe, []).append(key)
+                return None
+            name, host_env, host_count, _ = host
+            # The children of an alias are numbered from its own count.
+            shift = spawn_count - host_count
+            host_env.aliases.append((universe, shift, steps))
+            host_env.aliases += [(alias, offset + shift, done) for alias, offset, done in env.aliases]
+            env.aliases = []
+            self._forget(universe)
+        return name
+
+    def gather(self, children):
+        """
+        Merges those of children, (universe, env, start index) spawned by
+        one universe and not started yet, that cannot be told apart. Returns
+        the children left, and (universe, into) for each one merged.
+        """
+        kept, merged, hosts = [], [], {}
+        for child, env, start_index in children:
+            key, objects = self.key(start_index, env)
+            host = hosts.get(key) if key is not None else None
+            if host is None:
+                if key is not None:
+                    hosts[key] = (child, env, objects)
+                kept.append((child, env, start_index))
+                continue
+            name, host_env, _ = host
+            host_env.aliases.append((child, 0, 0))
+            host_env.aliases += env.aliases
+            merged.append((child, name))
+        return kept, merged
+
+    def settle(self, universe, env):
+        """
+        Called by a universe before anything it does can be seen: nothing is
+        merged into it from the statements it has passed any more. Returns
+        its aliases, as (name, spawn count offset, steps).
+        """
+        with self.lock:
+            self._forget(universe)
+            return list(env.aliases)
+
+    def _forget(self, universe):
+        for key in self.keys.pop(universe, ()):
+            del self.hosts[key]
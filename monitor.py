@@ -0,0 +1,409 @@
+import threading
+import json
+import time
+
+# Reasons a universe (or a fork that never got to be one) dies:
+#
+#   prophecy        a prophecy disagreed with the value it was about
+#   big-bang        a revision targeted a point before the start of time
+#   spawn-limit     MAX_SPAWN universes had already been spawned
+#   indeterminate   an output could not be fully evaluated
+#   error           the universe raised an exception
+#   replayed        a replay moved on to the child it was after (see replay)
+#
+# and, when the run has Limits, because it went over one of them (see LIMITS).
+
+LIMITS = ['step-limit', 'time-limit', 'history-limit', 'deadline']
+
+def universe_order(universe):
+    # root-0-2 is the third child of the first child of root; sorting on
+    #   this puts universes in the order they were forked, depth first.
+    return tuple(int(k) for k in universe.split('-')[1:])
+
+class Monitor:
+    """
+    Receives events from the engine. Every method is called from the thread
+    running the universe concerned, so implementations must do their own
+    locking.
+    """
+    @property
+    def wants_steps(self):
+        # Whether step does anything. There is one step per statement
+        #   executed, so the engine only times and reports them if so.
+        return type(self).step is not Monitor.step
+
+    def start(self, universe):
+        pass
+
+    def step(self, universe, stmt, elapsed):
+        # elapsed -- seconds spent resolving and executing stmt
+        pass
+
+    def spawn(self, universe, child, stmt, line, copied, value):
+        # line   -- source line after which the child resumes
+        # copied -- number of history elements copied into the child
+        # value  -- value the event revised by stmt takes in the child
+        pass
+
+    def abort(self, universe, stmt, reason):
+        # A fork requested by stmt died before it could be spawned.
+        pass
+
+    def merge(self, universe, into):
+        # universe stops, and into carries on for it (see Merger); it is
+        #   finished along with into, with the steps it executed itself.
+        pass
+
+    def finish(self, universe, steps, reason, line):
+        # steps  -- statements executed, or None if it raised an exception
+        # reason -- None if the universe ran to completion
+        pass
+
+class Monitors(Monitor):
+    def __init__(self, *monitors):
+        self.monitors = [m for m in monitors if m is not None]
+
+    @property
+    def wants_steps(self):
+        return any(m.wants_steps for m in self.monitors)
+
+    def start(self, *args):
+        for m in self.monitors: m.start(*args)
+
+    def step(self, *args):
+        for m in self.monitors: m.step(*args)
+
+    def spawn(self, *args):
+        for m in self.monitors: m.spawn(*args)
+
+    def abort(self, *args):
+        for m in self.monitors: m.abort(*args)
+
+    def merge(self, *args):
+        for m in self.monitors: m.merge(*args)
+
+    def finish(self, *args):
+        for m in self.monitors: m.finish(*args)
+
+def combine(*monitors):
+    # The monitors given that are not None, as one; None if there are none,
+    #   so that the engine does not pay for dispatching events nobody sees.
+    monitors = [m for m in monitors if m is not None]
+    if not monitors:
+        return None
+    return monitors[0] if len(monitors) == 1 else Monitors(*monitors)
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+class Statistics(Monitor):
+    FIELDS = [
+        ('spawned',       'universes spawned'),
+        ('completed',     'universes completed'),
+        ('prophecy',      'killed by prophecy violation'),
+        ('big_bang',      'forks before big-bang'),
+        ('indeterminate', 'failed on indeterminate output'),
+        ('spawn_limit',   'forks over the spawn limit'),
+        ('errors',        'universes that raised'),
+        ('merged',        'universes merged into another'),
+        ('pruned',        'pruned by a learned conflict'),
+        ('limited',       'killed by a resource limit'),
+        ('peak',          'peak concurrent universes'),
+        ('statements',    'statements executed'),
+        ('copied',        'history elements copied by forks'),
+        ('wall_time',     'wall time (s)'),
+    ]
+
+    def __init__(self):
+        for field, _ in self.FIELDS:
+            setattr(self, field, 0)
+        self.live = 0
+        self.lock = threading.Lock()
+
+    def start(self, universe):
+        with self.lock:
+            self.spawned += 1
+            self.live += 1
+            self.peak = max(self.peak, self.live)
+
+    def spawn(self, universe, child, stmt, line, copied, value):
+        with self.lock:
+            self.copied += copied
+
+    def abort(self, universe, stmt, reason):
+        with self.lock:
+            if reason == 'big-bang':
+                self.big_bang += 1
+            elif reason == 'spawn-limit':
+                self.spawn_limit += 1
+
+    def merge(self, universe, into):
+        with self.lock:
+            self.merged += 1
+
+    def finish(self, universe, steps, reason, line):
+        with self.lock:
+            self.live -= 1
+            self.statements += steps or 0
+            match reason:
+                case None:
+                    self.completed += 1
+                case 'prophecy':
+                    self.prophecy += 1
+                case 'indeterminate':
+                    self.indeterminate += 1
+                case 'error':
+                    self.errors += 1
+                case reason if reason in LIMITS:
+                    self.limited += 1
+
+    def add(self, saved):
+        # Folds in the as_dict() of an earlier part of the same run, which
+        #   may predate some of the fields.
+        for field, _ in self.FIELDS:
+            if field == 'peak':
+                self.peak = max(self.peak, saved.get(field, 0))
+            else:
+                setattr(self, field, getattr(self, field) + saved.get(field, 0))
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field, _ in self.FIELDS}
+
+    def __str__(self):
+        width = max(len(label) for _, label in self.FIELDS)
+        lines = []
+        for field, label in self.FIELDS:
+            value = getattr(self, field)
+            value = f'{value:.3f}' if isinstance(value, float) else str(value)
+            lines.append(f'{label.ljust(width)}  {value}')
+        return '\n'.join(lines)
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+class LineProfile:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.forks = 0
+        self.kills = {}     # reason -> count
+
+class Profiler(Monitor):
+    KILLS = ['prophecy', 'big-bang', 'indeterminate']
+
+    def __init__(self):
+        self.lines = {}
+        self.lock = threading.Lock()
+
+    def _line(self, line):
+        if line not in self.lines:
+            self.lines[line] = LineProfile()
+        return self.lines[line]
+
+    def step(self, universe, stmt, elapsed):
+        with self.lock:
+            profile = self._line(stmt.line)
+            profile.count += 1
+            profile.time += elapsed
+
+    def spawn(self, universe, child, stmt, line, copied, value):
+        with self.lock:
+            self._line(stmt.line).forks += 1
+
+    def _kill(self, line, reason):
+        with self.lock:
+            kills = self._line(line).kills
+            kills[reason] = kills.get(reason, 0) + 1
+
+    def abort(self, universe, stmt, reason):
+        self._kill(stmt.line, reason)
+
+    def finish(self, universe, steps, reason, line):
+        if reason is not None and line is not None:
+            self._kill(line, reason)
+
+    def report(self, statements, file=None):
+        text = {assn.line: str(assn).partition(': ')[2] for assn in statements}
+        # Deaths from resource limits only get a column if there were any.
+        kills = self.KILLS + [reason for reason in LIMITS
+                              if any(reason in p.kills for p in self.lines.values())]
+        header = ['line', 'count', 'time (ms)', 'forks'] + kills
+        rows = []
+        for line in sorted(self.lines):
+            p = self.lines[line]
+            counts = [str(p.kills.get(reason, 0)) for reason in kills]
+            rows.append([str(line), str(p.count), f'{1000 * p.time:.3f}', str(p.forks)] + counts)
+        widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+        print('  '.join(h.rjust(w) for h, w in zip(header, widths)), file=file)
+        for line, row in zip(sorted(self.lines), rows):
+            cells = '  '.join(c.rjust(w) for c, w in zip(row, widths))
+            print(f'{cells}  \x1B[2m{text[line]}\x1B[22m', file=file)
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+class UniverseRecord:
+    def __init__(self, universe, tid):
+        self.universe = universe
+        self.tid = tid
+        self.parent = None
+        self.fork_line = None   # line of the revision that spawned it
+        self.line = None        # line after which it resumed
+        self.start = None
+        self.end = None
+        self.steps = 0
+        self.reason = None
+        self.death_line = None
+
+class Tracer(Monitor):
+    """
+    Records the universe tree with timestamps, for export in the Chrome
+    trace event format (chrome://tracing, Perfetto, and the like). Each
+    universe gets a track of its own.
+    """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.universes = {}
+        self.instants = []      # (universe, timestamp, name, args)
+        self.lock = threading.Lock()
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _record(self, universe):
+        if universe not in self.universes:
+            self.universes[universe] = UniverseRecord(universe, len(self.universes))
+        return self.universes[universe]
+
+    def start(self, universe):
+        now = self._now()
+        with self.lock:
+            self._record(universe).start = now
+
+    def spawn(self, universe, child, stmt, line, copied, value):
+        now = self._now()
+        with self.lock:
+            record = self._record(child)
+            record.parent = universe
+            record.fork_line = stmt.line
+            record.line = line
+            self.instants.append((universe, now, 'fork', {'child': child, 'line': stmt.line, 'target': str(stmt.left),
+                                                          'value': str(value)}))
+
+    def abort(self, universe, stmt, reason):
+        now = self._now()
+        with self.lock:
+            self.instants.append((universe, now, reason, {'line': stmt.line, 'target': str(stmt.left)}))
+
+    def merge(self, universe, into):
+        now = self._now()
+        with self.lock:
+            self._record(universe)
+            self.instants.append((universe, now, 'merged', {'into': into}))
+
+    def finish(self, universe, steps, reason, line):
+        now = self._now()
+        with self.lock:
+            record = self._record(universe)
+            record.end = now
+            record.steps = steps or 0
+            record.reason = reason
+            record.death_line = line
+
+    def events(self):
+        events = []
+        for record in self.universes.values():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': record.tid,
+                           'args': {'name': record.universe}})
+            if record.start is None:
+                continue
+            end = record.end if record.end is not None else self._now()
+            args = {
+                'parent': record.parent,
+                'fork line': record.fork_line,
+                'resumed after line': record.line,
+                'steps': record.steps,
+                'outcome': record.reason or 'completed',
+            }
+            if record.death_line is not None:
+                args['death line'] = record.death_line
+            events.append({'name': record.universe, 'cat': 'universe', 'ph': 'X', 'pid': 0,
+                           'tid': record.tid, 'ts': record.start, 'dur': end - record.start, 'args': args})
+        for universe, ts, name, args in self.instants:
+            tid = self.universes[universe].tid
+            events.append({'name': name, 'cat': 'fork', 'ph': 'i', 's': 't', 'pid': 0,
+                           'tid': tid, 'ts': ts, 'args': args})
+            if name == 'fork' and self.universes[args['child']].start is not None:
+                # Flow arrow from the revision to the start of the child.
+                child = self.universes[args['child']]
+                events.append({'name': 'fork', 'cat': 'fork', 'ph': 's', 'id': child.tid,
+                               'pid': 0, 'tid': tid, 'ts': ts})
+                events.append({'name': 'fork', 'cat': 'fork', 'ph': 'f', 'bp': 'e', 'id': child.tid,
+                               'pid': 0, 'tid': child.tid, 'ts': child.start})
+        return events
+
+    def export(self, fh):
+        with self.lock:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, fh)
+
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
+
+class Fork:
+    # How a universe came to be: its parent revised the event variable@index
+    #   to value, with the statement at position code_index in the program,
+    #   and the universe resumed after line.
+    FIELDS = ['universe', 'parent', 'code_index', 'variable', 'index', 'value', 'line']
+
+    def __init__(self, universe, parent, code_index, variable, index, value, line):
+        self.universe = universe
+        self.parent = parent
+        self.code_index = code_index
+        self.variable = variable
+        self.index = index
+        self.value = value      # as text, so that forks can be saved as JSON
+        self.line = line
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def same_as(self, other):
+        return all(getattr(self, field) == getattr(other, field) for field in self.FIELDS)
+
+    def __str__(self):
+        return f'{self.universe}: {self.parent} revised {self.variable}@{self.index} = {self.value}, resumed after line {self.line}'
+
+class Lineage(Monitor):
+    """
+    Records the fork that produced each universe, so that the chain of
+    forks leading to any of them can be followed back to root. statements
+    are those being run, which code indexes refer to.
+    """
+    def __init__(self, statements=()):
+        self.positions = {id(assn): k for k, assn in enumerate(statements)}
+        self.forks = {}         # universe -> Fork
+        self.lock = threading.Lock()
+
+    def spawn(self, universe, child, stmt, line, copied, value):
+        fork = Fork(child, universe, self.positions.get(id(stmt)), stmt.left.name, stmt.left.index, str(value), line)
+        with self.lock:
+            self.forks[child] = fork
+
+    def chain(self, universe):
+        # The forks from root down to universe, as far as they were recorded.
+        chain = []
+        while universe in self.forks:
+            chain.append(self.forks[universe])
+            universe = self.forks[universe].parent
+        return chain[::-1]
+
+    def export(self, fh):
+        # One fork per line, in the order the universes were forked.
+        with self.lock:
+            for universe in sorted(self.forks, key=universe_order):
+                fh.write(json.dumps(self.forks[universe].as_dict()) + '\n')
+
+    @classmethod
+    def load(cls, fh):
+        lineage = cls()
+        for line in fh:
+            if line.strip():
+                fork = Fork(**json.loads(line))
+                lineage.forks[fork.universe] = fork
+        return lineage
@@ -0,0 +1,117 @@
+import threading
+
+from objects import *
+from program import *
+from merge   import events_read
+
+# Conflict learning. When a prophecy is violated, what made it so is
+#   recorded as a nogood: the statement before which it was found, the
+#   prophecy, and the values of every event its check can depend on -- those
+#   its expression and the event it is about refer to, and those that went
+#   into any of them left unevaluated. A universe about to start is killed
+#   right away, for the same reason and line, if it cannot help running into
+#   a nogood: it holds the same values already, or is about to assign them
+#   as constants, and has nothing else to do on the way that could be seen
+#   -- no fork, no dbg and no other prophecy.
+
+class Nogoods:
+    """
+    The nogoods learned so far in a run, and the universes they pruned.
+    """
+    def __init__(self, code):
+        n = len(code)
+        ops, slots, indexes = code.ops, code.slots, code.indexes
+        self.defs = {}          # (slot, index) -> statement that appends it
+        for pc in range(n):
+            if ops[pc] == MUTATE or ops[pc] == DEBUG:
+                self.defs[(slots[pc], indexes[pc])] = pc
+        reads = [events_read(expr) for expr in code.exprs]
+        self.values, self.constants, self.lines = code.values, code.constants, code.lines
+
+        # For each prophecy, the events its check depends on, in the order
+        #   they are appended.
+        self.prophecy_of = {}   # id of the Variable a prophecy is about -> its statement
+        self.depends = {}       # statement of a prophecy -> events
+        for pc in range(n):
+            if ops[pc] != PROPHESY:
+                continue
+            self.prophecy_of[id(code.statements[pc].left)] = pc
+            found = set()
+            todo = reads[pc] | {(slots[pc], indexes[pc])}
+            while todo:
+                e = todo.pop()
+                if e in self.defs and e not in found:
+                    found.add(e)
+                    todo |= reads[self.defs[e]]
+            self.depends[pc] = sorted(found, key=self.defs.get)
+
+        # loud[pc] -- the first statement from pc on that forks or dbgs.
+        self.loud = [n] * (n + 1)
+        for pc in reversed(range(n)):
+            self.loud[pc] = pc if ops[pc] == REVISE or ops[pc] == DEBUG else self.loud[pc + 1]
+        self.prophecies = [pc for pc in range(n) if ops[pc] == PROPHESY]
+
+        self.nogoods = {}       # (statement, prophecy) -> {ids of values: universe it was learned from}
+        self.held = []          # the values themselves, which the ids are only good for while alive
+        self.pruned = 0
+        self.lock = threading.Lock()
+
+    def learn(self, universe, env, pc, var):
+        """
+        Records that the prophecy about var was violated in universe, in the
+        check before statement pc (len(code) for the last one).
+        """
+        prophecy = self.prophecy_of[id(var)]
+        values = [env.var_histories[slot][index].expression
+                  for slot, index in self.depends[prophecy] if self.defs[(slot, index)] < pc]
+        key = tuple(id(value) for value in values)
+        with self.lock:
+            found = self.nogoods.setdefault((pc, prophecy), {})
+            if key not in found:
+                found[key] = universe
+                self.held.append(values)
+
+    def conflict(self, env, start_index):
+        """
+        The nogood a universe starting at start_index is bound to run into,
+        as (line of the prophecy, universe it was learned from), or None.
+        """
+        if not self.nogoods:
+            return None
+        pending = env.code_history[-1] if len(env.code_history) else None
+        if pending is not None and (pending.pending_forks or pending.pending_dbgs):
+            return None
+        waiting = {self.prophecy_of[id(var)] for var, _, _ in pending.prophecies} if pending is not None else set()
+        if len(waiting) > 1:
+            return None
+        with self.lock:
+            candidates = list(self.nogoods.items())
+        for (pc, prophecy), found in candidates:
+            if pc < start_index or self.loud[start_index] < pc:
+                continue
+            ahead = {p for p in self.prophecies if start_index <= p < pc}
+            if not waiting | ahead <= {prophecy} or prophecy not in waiting | ahead:
+                continue
+            key = self._predict(env, start_index, pc, prophecy)
+            learned = found.get(key) if key is not None else None
+            if learned is not None:
+                with self.lock:
+                    self.pruned += 1
+                return self.lines[prophecy], learned
+        return None
+
+    def _predict(self, env, start_index, pc, prophecy):
+        # The key the universe will have learned from by statement pc, if it
+        #   can be told before it runs anything.
+        key = []
+        for slot, index in self.depends[prophecy]:
+            where = self.defs[(slot, index)]
+            if where >= pc:
+                break
+            if where < start_index:
+                key.append(id(env.var_histories[slot][index].expression))
+            elif self.values[where] >= 0:
+                key.append(id(self.constants[self.values[where]]))
+            else:
+                return None
+        return tuple(key)
@@ -1,8 +1,37 @@
+import array
+import functools
+import threading
+import weakref
+
+class _InternTable:
+    # Weakly maps keys to the canonical instance for that key, so values no
+    #   universe refers to any more can still be collected. Lookups take no
+    #   lock; the lock is reentrant because a weakref callback can run in the
+    #   thread that holds it.
+    def __init__(self):
+        self.refs = {}
+        self.lock = threading.RLock()
+
+    def insert(self, key, obj):
+        with self.lock:
+            ref = self.refs.get(key)
+            existing = ref() if ref is not None else None
+            if existing is not None:
+                return existing
+            self.refs[key] = weakref.ref(obj, functools.partial(self._forget, key))
+            return obj
+
+    def _forget(self, key, ref):
+        with self.lock:
+            if self.refs.get(key) is ref:
+                del self.refs[key]
+
 class Variable:
-    def __init__(self, name, index, offset=None):
+    def __init__(self, name, index, offset=None, slot=None):
         self.name = name
         self.index = index
         self.offset = offset
+        self.slot = slot        # assigned by reindex
 
     def _str(self, parenthesize):
         return f'{self.name}@{self.index}'
@@ -11,24 +40,22 @@ class Variable:
         return self._str(False)
 
     def defined(self, env):
-        if self.name not in env.var_count:
+        if self.slot is None:
             raise AssertionError()
         if self.index < 0:
             return False
-        if not self.index < env.var_count[self.name]:
+        if not self.index < env.counts[self.slot]:
             return False
         return True
 
     def eval(self, env, visited=None):
         visited = visited or set()
-        if self.name in visited:
+        if self.slot in visited:
             return None
-        visited.add(self.name)
+        visited.add(self.slot)
         if not self.defined(env):
             return UNDEFINED
-        if self.name not in env.var_histories:
-            return None
-        history = env.var_histories[self.name]
+        history = env.var_histories[self.slot]
         if not self.index < len(history):
             return None
         return history[self.index].expression.eval(env, visited)
@@ -55,12 +82,45 @@ class Undefined:
     def eval(self, env, visited=None):
         return self
 
+    def __reduce__(self):
+        return 'UNDEFINED'
+
 UNDEFINED = Undefined()
 
 class Literal:
-    def __init__(self, value, kind):
-        self.value = value
-        self.kind = kind
+    """
+    Values are hash-consed: there is only ever one live concrete Tuple for a
+    given sequence of elements, so tuples compare and hash by identity, and
+    Literals of the same kind and value are nearly always the same object,
+    so values are shared between universes.
+    """
+    __slots__ = ('value', 'kind')
+
+    # Literals are small and created constantly, mostly with values seen
+    #   shortly before, so they are kept in a plain dict rather than paying
+    #   for weakrefs. The dict is emptied whenever it fills up, for a long
+    #   process not to hold every value it ever computed; a Literal made
+    #   before that is still equal to the one made after.
+    _interned = {}
+    INTERNED = 1 << 16
+
+    def __new__(cls, value, kind):
+        key = (kind, value)
+        literal = cls._interned.get(key)
+        if literal is None:
+            literal = object.__new__(cls)
+            object.__setattr__(literal, 'value', value)
+            object.__setattr__(literal, 'kind', kind)
+            if len(cls._interned) >= cls.INTERNED:
+                cls._interned.clear()
+            literal = cls._interned.setdefault(key, literal)
+        return literal
+
+    def __setattr__(self, name, value):
+        raise AttributeError('literals are immutable')
+
+    def __reduce__(self):
+        return (Literal, (self.value, self.kind))
 
     def _str(self, parenthesize):
         match self.kind:
@@ -76,8 +136,14 @@ class Literal:
     def __str__(self):
         return self._str(False)
 
+    # Spelled out, rather than inherited from object, so that comparing with
+    #   UNDEFINED never falls back on Undefined.__eq__.
     def __eq__(self, other):
-        return isinstance(other, Literal) and self.value == other.value
+        return self is other or (other.__class__ is Literal and self.kind == other.kind
+                                 and self.value == other.value)
+
+    def __hash__(self):
+        return hash((self.kind, self.value))
 
     def defined(self, env):
         return True
@@ -85,14 +151,113 @@ class Literal:
     def eval(self, env, visited=None):
         return self
 
+# Typecodes of the arrays that hold packed tuples: bools take a byte each,
+#   and ints the narrowest signed type their range fits in.
+BOOL_CODE = 'B'
+INT_CODES = [(code, 1 << (8 * array.array(code).itemsize - 1)) for code in 'bhiq']
+
+def _pack(elements):
+    # An array of the values of elements, if they are all bools or all ints
+    #   that fit in 64 bits, or else None.
+    if not elements:
+        return None
+    kind = elements[0].kind
+    if kind != 'bool' and kind != 'int':
+        return None
+    for elem in elements:
+        if elem.kind != kind:
+            return None
+    values = [elem.value for elem in elements]
+    if kind == 'bool':
+        return array.array(BOOL_CODE, values)
+    low, high = min(values), max(values)
+    for code, bound in INT_CODES:
+        if -bound <= low and high < bound:
+            return array.array(code, values)
+    return None
+
+def _packed(code, data):
+    # Unpickles a packed Tuple.
+    packed = array.array(code)
+    packed.frombytes(data)
+    return Tuple._intern(packed)
+
 class Tuple:
-    def __init__(self, elements, concrete=False):
-        self.elements = elements
-        self.kind = 'tuple'
-        self.concrete = concrete
+    # A concrete tuple is a value and is interned by its elements, which are
+    #   themselves interned; any other tuple is an expression. A concrete
+    #   tuple of bools or of ints is packed: its elements are an array of
+    #   their values rather than of Literals, and it is interned by the bytes
+    #   of the array. Whether a tuple is packed only depends on its elements,
+    #   so the same elements are never interned twice.
+    __slots__ = ('elements', 'kind', 'concrete', 'packed', '__weakref__')
+
+    _interned = _InternTable()
+
+    def __new__(cls, elements, concrete=False):
+        if not concrete:
+            return cls._make(elements, False)
+        packed = _pack(elements)
+        if packed is not None:
+            return cls._intern(packed)
+        key = tuple(elements)
+        ref = cls._interned.refs.get(key)
+        value = ref() if ref is not None else None
+        if value is None:
+            value = cls._interned.insert(key, cls._make(key, True))
+        return value
+
+    @classmethod
+    def _intern(cls, packed):
+        key = (packed.typecode, packed.tobytes())
+        ref = cls._interned.refs.get(key)
+        value = ref() if ref is not None else None
+        if value is None:
+            value = cls._interned.insert(key, cls._make(packed, True, True))
+        return value
+
+    @classmethod
+    def _make(cls, elements, concrete, packed=False):
+        value = object.__new__(cls)
+        object.__setattr__(value, 'elements', elements)
+        object.__setattr__(value, 'kind', 'tuple')
+        object.__setattr__(value, 'concrete', concrete)
+        object.__setattr__(value, 'packed', packed)
+        return value
+
+    def __setattr__(self, name, value):
+        raise AttributeError('tuples are immutable')
+
+    def __reduce__(self):
+        if self.packed:
+            return (_packed, (self.elements.typecode, self.elements.tobytes()))
+        return (Tuple, (self.elements, self.concrete))
+
+    def item(self, k):
+        # The k-th element, as a Literal if the tuple is packed.
+        if not self.packed:
+            return self.elements[k]
+        if self.elements.typecode == BOOL_CODE:
+            return Literal(bool(self.elements[k]), 'bool')
+        return Literal(self.elements[k], 'int')
+
+    def __iter__(self):
+        for k in range(len(self.elements)):
+            yield self.item(k)
+
+    def join(self, other):
+        # The concatenation of two concrete tuples.
+        if self.packed and other.packed:
+            mine, theirs = self.elements, other.elements
+            if (mine.typecode == BOOL_CODE) == (theirs.typecode == BOOL_CODE):
+                if mine.itemsize < theirs.itemsize:
+                    mine = array.array(theirs.typecode, mine)
+                elif theirs.itemsize < mine.itemsize:
+                    theirs = array.array(mine.typecode, theirs)
+                return Tuple._intern(mine + theirs)
+        return Tuple(list(self) + list(other), concrete=True)
 
     def _str(self, parenthesize):
-        inner = ", ".join(elem._str(False) for elem in self.elements)
+        inner = ", ".join(elem._str(False) for elem in self)
         return f'[{inner}]'
 
     def __str__(self):
@@ -102,14 +267,12 @@ class Tuple:
         return len(self.elements)
 
     def __eq__(self, other):
-        if not isinstance(other, Tuple):
-            return False
-        assert self.concrete
-        assert other.concrete
-        return other.elements == self.elements
+        return self is other
+
+    __hash__ = object.__hash__
 
     def defined(self, env):
-        return all(elem.defined(env) for elem in self.elements)
+        return self.packed or all(elem.defined(env) for elem in self.elements)
 
     def eval(self, env, visited=None):
         if self.concrete:
@@ -158,7 +321,7 @@ class UnaryExpression:
                 return Literal(not operand.value, 'bool')
             case "len":
                 if operand.kind == 'tuple':
-                    return Literal(len(operand.elements), 'int')
+                    return Literal(len(operand), 'int')
                 if operand.kind == 'atom':
                     return Literal(len(operand.value), 'int')
                 raise AssertionError()
@@ -195,7 +358,7 @@ class BinaryExpression:
             assert left.kind == 'tuple' and right.kind == 'int'
             if right.value < 0 or not right.value < len(left):
                 return UNDEFINED
-            return left.elements[right.value]
+            return left.item(right.value)
         assert left.kind == right.kind, f"{left.kind} != {right.kind}, {self.operator}"
         kind = left.kind
         match self.operator:
@@ -203,7 +366,7 @@ class BinaryExpression:
                 if kind == 'int':
                     return Literal(left.value + right.value, 'int')
                 elif kind == 'tuple':
-                    return Tuple(left.elements + right.elements)
+                    return left.join(right)
                 elif kind == 'atom':
                     return Literal(left.value + right.value, 'atom')
                 else:
@@ -0,0 +1,109 @@
+from objects import *
+
+# Passes over reindexed statements. They build new Assignments rather than
+#   mutating their input, so the same program can be run both with and
+#   without them.
+
+NEGATIONS = {
+    'eq':  'neq',
+    'neq': 'eq',
+    'gt':  'leq',
+    'lt':  'geq',
+    'geq': 'lt',
+    'leq': 'gt',
+}
+
+class StaticEnvironment:
+    # Just enough of an Environment for Variable.defined, which only depends
+    #   on the indices and slots assigned by reindex.
+    def __init__(self, var_count):
+        self.var_count = var_count
+        self.counts = list(var_count.values())
+
+def is_constant(expr):
+    if isinstance(expr, (Literal, Undefined)):
+        return True
+    return isinstance(expr, Tuple) and expr.concrete
+
+def is_boolean(expr):
+    # True if expr can only evaluate to a bool (or be unknown or undefined).
+    if isinstance(expr, Literal):
+        return expr.kind == 'bool'
+    if isinstance(expr, UnaryExpression):
+        return expr.operator in ('def', 'not')
+    if isinstance(expr, BinaryExpression):
+        if expr.operator in NEGATIONS:
+            return True
+        if expr.operator in ('and', 'or'):
+            return is_boolean(expr.left) and is_boolean(expr.right)
+    return False
+
+def _evaluate(expr):
+    # Operators assert on ill-typed operands and Python raises on division by
+    #   zero; those expressions are left alone so that they fail at run time,
+    #   in the universe that executes them, exactly as before.
+    try:
+        value = expr.eval(None)
+    except (AssertionError, ArithmeticError):
+        return expr
+    if value is None:
+        return expr
+    return value
+
+def fold(expr, env):
+    if isinstance(expr, Tuple):
+        if expr.concrete:
+            return expr
+        elements = [fold(elem, env) for elem in expr.elements]
+        folded = Tuple(elements)
+        if all(is_constant(elem) for elem in elements):
+            return _evaluate(folded)
+        return folded
+
+    if isinstance(expr, UnaryExpression):
+        if expr.operator == 'def':
+            return Literal(expr.operand.defined(env), 'bool')
+        operand = fold(expr.operand, env)
+        if is_constant(operand):
+            return _evaluate(UnaryExpression(operand, expr.operator))
+        if expr.operator == 'not':
+            if isinstance(operand, BinaryExpression) and operand.operator in NEGATIONS:
+                return BinaryExpression(operand.left, operand.right, NEGATIONS[operand.operator])
+            if isinstance(operand, UnaryExpression) and operand.operator == 'not' \
+                    and is_boolean(operand.operand):
+                return operand.operand
+        return UnaryExpression(operand, expr.operator)
+
+    if isinstance(expr, BinaryExpression):
+        left = fold(expr.left, env)
+        right = fold(expr.right, env)
+        folded = BinaryExpression(left, right, expr.operator)
+        if is_constant(left) and is_constant(right):
+            return _evaluate(folded)
+        # x ∧ true and x ∨ false are x, provided x is known to be a bool (for
+        #   integers these operators are min and max).
+        identity = {'and': True, 'or': False}.get(expr.operator)
+        if identity is not None:
+            for this, that in ((left, right), (right, left)):
+                if isinstance(that, Literal) and that.kind == 'bool' \
+                        and that.value == identity and is_boolean(this):
+                    return this
+        return folded
+
+    return expr
+
+def optimize(statements, var_count, dbg_name="dbg"):
+    """
+    Folds constant subexpressions, prebuilds concrete tuples, and simplifies
+    trivial boolean forms. Debug statements are left untouched since their
+    output includes the text of the expression.
+    """
+    env = StaticEnvironment(var_count)
+    optimized = []
+    for assn in statements:
+        if assn.left.name == dbg_name:
+            optimized.append(assn)
+            continue
+        right = fold(assn.right, env)
+        optimized.append(Assignment(assn.left, right, assn.kind, assn.line))
+    return optimized
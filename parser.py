@@ -1,3 +1,6 @@
+import multiprocessing
+import re
+
 from lexer import *
 from objects import *
 
@@ -438,43 +441,165 @@ def reify(statement):
 
     return Assignment(lefthand, righthand, kind, statement.left().line)
 
-def _reindex(obj, count):
+def parse_program(stream):
+    """
+    Parses and reifies every statement in the stream. Returns a list of
+    Assignments, or the first ParseFailure.
+    """
+    statements = []
+    while True:
+        result = parse_statement(stream)
+        if result is None:
+            return statements
+        if isinstance(result, ParseFailure):
+            return result
+        reified = reify(result)
+        if isinstance(reified, ParseFailure):
+            return reified
+        statements.append(reified)
+
+def _slot(var, count, slots):
+    # Every name enters count and slots together, so the names of count are
+    #   in slot order.
+    if var.name not in slots:
+        slots[var.name] = len(slots)
+        count[var.name] = -1
+    var.slot = slots[var.name]
+
+def _reindex(obj, count, slots):
     if isinstance(obj, Variable):
-        if obj.name not in count:
-            count[obj.name] = -1
+        _slot(obj, count, slots)
         obj.index = count[obj.name] + (0 if obj.offset is None else obj.offset)
     if isinstance(obj, Tuple):
         for elem in obj.elements:
-            _reindex(elem, count)
+            _reindex(elem, count, slots)
     if isinstance(obj, UnaryExpression):
-        _reindex(obj.operand, count)
+        _reindex(obj.operand, count, slots)
     if isinstance(obj, BinaryExpression):
-        _reindex(obj.left, count)
-        _reindex(obj.right, count)
+        _reindex(obj.left, count, slots)
+        _reindex(obj.right, count, slots)
+
+def _index(assn, count, slots):
+    if not isinstance(assn, Assignment):
+        raise NotImplementedError()
+
+    _reindex(assn.right, count, slots)
+    _slot(assn.left, count, slots)
+
+    if assn.kind == Assignment.MUTATION:
+        x = count[assn.left.name] + 1
+        assn.left.index = x
+        count[assn.left.name] = x
+
+    if assn.kind == Assignment.REVISION:
+        assn.left.index = count[assn.left.name] + assn.left.offset
+
+    if assn.kind == Assignment.PROPHECY:
+        assn.left.index = count[assn.left.name] + assn.left.offset
 
 def reindex(statements):
+    """
+    Assigns every variable its index in the history of its name, and a slot
+    numbering names densely in order of first appearance. Returns the number
+    of mutations of each name, with the names in slot order.
+    """
     count = {}
+    slots = {}
     for assn in statements:
-        if not isinstance(assn, Assignment):
-            raise NotImplementedError()
+        _index(assn, count, slots)
 
-        _reindex(assn.right, count)
+    return {name: n + 1 for name, n in count.items()}
 
-        if assn.kind == Assignment.MUTATION:
-            x = count.get(assn.left.name, -1) + 1
-            assn.left.index = x
-            count[assn.left.name] = x
+# How often reindex_from marks where it is.
+MARK = 256
 
-        if assn.kind == Assignment.REVISION:
-            assn.left.index = count.get(assn.left.name, -1) + assn.left.offset
+def reindex_from(statements, marks, start=0, stop=None):
+    """
+    Does what reindex does, keeping in marks, a dict, the state indexing is
+    in before every MARKth statement and after the last one, by position.
+    Indexing starts at the last mark at or before start, which statements
+    before it must not have changed since. stop, if given, holds marks from
+    an earlier indexing of the statements from some position on, which have
+    not changed since either, at their positions now: indexing stops at the
+    first of them it finds in the same state, which the statements from there
+    on are then indexed for already.
+    """
+    start = max((k for k in marks if k <= start), default=0)
+    count, slots = ({}, {}) if start not in marks else (dict(marks[start][0]), dict(marks[start][1]))
+    for k in [k for k in marks if k > start]:
+        del marks[k]
+    for k in range(start, len(statements)):
+        if stop is not None and k in stop and stop[k] == (count, slots):
+            marks.update((j, state) for j, state in stop.items() if j >= k)
+            count = stop[len(statements)][0]
+            break
+        if k % MARK == 0:
+            marks[k] = (dict(count), dict(slots))
+        _index(statements[k], count, slots)
+    else:
+        marks[len(statements)] = (dict(count), dict(slots))
+
+    return {name: n + 1 for name, n in count.items()}
 
-        if assn.kind == Assignment.PROPHECY:
-            assn.left.index = count.get(assn.left.name, -1) + assn.left.offset
+#~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
 
-    for name in count:
-        count[name] += 1
+# Parsing in parallel. Statements only depend on one another through
+#   reindex, which comes after, so a program file can be cut at any newline
+#   outside brackets, strings and comments, where a statement is bound to
+#   end, and the pieces parsed and reified by a pool of processes. Each piece
+#   is lexed from the line it starts on, so the line numbers and failures are
+#   those parsing the whole file gives.
 
-    return count
+# What can hide a newline from the parser, or be one.
+_boundary = re.compile(rb'"(?:[^"\\]|\\.)*"?|(?://|--|\xe2\x80\xbb)[^\n]*|[()\[\]]|\n')
+
+def split_program(data, size):
+    """
+    Cuts data, the bytes of a program, into pieces of about size bytes or
+    more, at newlines where no statement can go on. Returns them as (start,
+    end, line it starts on).
+    """
+    pieces = []
+    start, first = 0, 1
+    depth, line = 0, 1
+    for match in _boundary.finditer(data):
+        char = data[match.start()]
+        if char == 0x0A:
+            line += 1
+            if depth == 0 and match.end() - start >= size:
+                pieces.append((start, match.end(), first))
+                start, first = match.end(), line
+        elif char == 0x22:
+            line += match.group().count(b'\n')
+        elif char == 0x28 or char == 0x5B:
+            depth += 1
+        elif char == 0x29 or char == 0x5D:
+            depth = max(0, depth - 1)
+    if start < len(data) or not pieces:
+        pieces.append((start, len(data), first))
+    return pieces
+
+def _parse_piece(path, start, end, line):
+    with Source(path, start=start, end=end) as source:
+        return parse_program(TokenStream.of(source, line))
+
+def parse_parallel(source, jobs, size=1 << 16):
+    """
+    Parses and reifies every statement of a Source with jobs processes, in
+    pieces of about size bytes. Returns what parse_program would.
+    """
+    pieces = split_program(source.data, max(size, len(source.data) // (4 * jobs)))
+    if len(pieces) == 1:
+        return parse_program(TokenStream.of(source))
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(jobs, len(pieces))) as pool:
+        results = pool.starmap(_parse_piece, [(source.path,) + piece for piece in pieces], chunksize=1)
+    statements = []
+    for result in results:
+        if isinstance(result, ParseFailure):
+            return result
+        statements += result
+    return statements
 
 #~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ ~
 
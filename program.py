@@ -0,0 +1,67 @@
+from objects import *
+from optimizer import is_constant
+
+# Opcodes. A mutation of the debug variable gets an opcode of its own, so the
+#   engine never has to compare names while running.
+MUTATE   = 0
+DEBUG    = 1
+REVISE   = 2
+PROPHESY = 3
+
+OPCODES = {
+    Assignment.MUTATION: MUTATE,
+    Assignment.REVISION: REVISE,
+    Assignment.PROPHECY: PROPHESY,
+}
+
+class Program:
+    """
+    A reindexed statement list laid out for the engine. Statement i is
+    described by the i-th entry of each of the parallel lists below, with
+    variables replaced by the integer slots reindex gave them; constant
+    right-hand sides are taken from a shared pool instead of being
+    evaluated.
+    """
+    def __init__(self):
+        self.statements = []    # the Assignments themselves, for monitors and forks
+        self.ops = []
+        self.slots = []         # slot of the variable assigned
+        self.indexes = []       # index of the event assigned
+        self.exprs = []         # right-hand sides
+        self.values = []        # position of the right-hand side in constants, or -1
+        self.lines = []
+        self.constants = []
+        self.names = []         # slot -> variable name
+        self.slot_of = {}       # variable name -> slot
+        self.pooled = {}        # id of a constant -> its position in constants
+
+    def __len__(self):
+        return len(self.ops)
+
+    def constant(self, value):
+        # Values are interned, so the pool holds each of them once.
+        if id(value) not in self.pooled:
+            self.pooled[id(value)] = len(self.constants)
+            self.constants.append(value)
+        return self.pooled[id(value)]
+
+def compile_program(statements, var_count, dbg_name="dbg"):
+    """
+    Compiles reindexed statements into a Program. var_count is as returned
+    by reindex, with its names in slot order.
+    """
+    program = Program()
+    program.names = list(var_count)
+    program.slot_of = {name: slot for slot, name in enumerate(program.names)}
+    for assn in statements:
+        op = OPCODES[assn.kind]
+        if op == MUTATE and assn.left.name == dbg_name:
+            op = DEBUG
+        program.statements.append(assn)
+        program.ops.append(op)
+        program.slots.append(assn.left.slot)
+        program.indexes.append(assn.left.index)
+        program.exprs.append(assn.right)
+        program.values.append(program.constant(assn.right) if is_constant(assn.right) else -1)
+        program.lines.append(assn.line)
+    return program
@@ -0,0 +1,144 @@
+import array
+import bisect
+import mmap
+import tempfile
+import threading
+
+from checkpoint import Codec
+
+class SpillStore:
+    """
+    An append-only temporary file, mapped into memory, that holds pickled
+    history elements no longer worth keeping as objects. One store is
+    shared by every universe of a run, which closes it once it is over
+    (it is a context manager).
+    """
+    def __init__(self, statements, keep=64, directory=None):
+        # keep -- elements at the end of each history that stay in memory
+        self.codec = Codec(statements)
+        self.keep = keep
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.size = 0
+        self.capacity = mmap.PAGESIZE
+        self.file.truncate(self.capacity)
+        self.map = mmap.mmap(self.file.fileno(), self.capacity)
+        self.lock = threading.Lock()
+
+    def put(self, elements):
+        # Returns the (offset, length) of each element, flattened.
+        records = [self.codec.dumps(elem) for elem in elements]
+        refs = array.array('q')
+        with self.lock:
+            needed = self.size + sum(len(r) for r in records)
+            if needed > self.capacity:
+                while needed > self.capacity:
+                    self.capacity *= 2
+                self.file.truncate(self.capacity)
+                # The old map stays valid for whoever is still reading it,
+                #   since the file only ever grows.
+                self.map = mmap.mmap(self.file.fileno(), self.capacity)
+            for record in records:
+                self.map[self.size:self.size + len(record)] = record
+                refs.append(self.size)
+                refs.append(len(record))
+                self.size += len(record)
+        return refs
+
+    def get(self, offset, length):
+        return self.codec.loads(self.map[offset:offset + length])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SpilledHistory:
+    """
+    A list of history elements whose oldest elements live in a SpillStore.
+    Only what Environment and the engine use is supported: indexing,
+    prefix slices, assignment, append and iteration.
+
+    The cold part is a tuple of segments, each a flat array of (offset,
+    length) pairs written by one spill. Segments are never modified, so
+    prefix slices share them, and forking a universe only copies the few
+    elements still in memory.
+    """
+    __slots__ = ('store', 'segments', 'starts', 'cold_len', 'hot')
+
+    def __init__(self, store, segments=(), starts=(), cold_len=0, hot=None):
+        self.store = store
+        self.segments = segments
+        self.starts = starts    # index of the first element of each segment
+        self.cold_len = cold_len
+        self.hot = hot if hot is not None else []
+
+    def __len__(self):
+        return self.cold_len + len(self.hot)
+
+    def _cold(self, k):
+        i = bisect.bisect_right(self.starts, k) - 1
+        j = 2 * (k - self.starts[i])
+        return self.store.get(self.segments[i][j], self.segments[i][j + 1])
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            assert k.start is None and k.step is None, "Only prefixes of histories can be taken."
+            _, end, _ = k.indices(len(self))
+            # Whatever is still in memory gets copied, so move it out first,
+            #   once for every universe forked from here.
+            self.spill(self.store.keep)
+            if end <= self.cold_len:
+                return SpilledHistory(self.store, self.segments, self.starts, end)
+            return SpilledHistory(self.store, self.segments, self.starts, self.cold_len,
+                                  self.hot[:end - self.cold_len])
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('history index out of range')
+        if k < self.cold_len:
+            return self._cold(k)
+        return self.hot[k - self.cold_len]
+
+    def __setitem__(self, k, elem):
+        if k < 0:
+            k += len(self)
+        if k >= self.cold_len:
+            self.hot[k - self.cold_len] = elem
+            return
+        # Bring everything from k on back into memory, leaving the shared
+        #   segments untouched.
+        self.hot = [elem] + [self._cold(j) for j in range(k + 1, self.cold_len)] + self.hot
+        self.cold_len = k
+
+    def __iter__(self):
+        for k in range(self.cold_len):
+            yield self._cold(k)
+        yield from self.hot
+
+    def append(self, elem):
+        self.hot.append(elem)
+
+    def spill(self, threshold=None):
+        # Once more than threshold elements are in memory (by default twice
+        #   the store's keep, so that spills come in batches), moves all but
+        #   the last keep of them to the store.
+        keep = self.store.keep
+        if len(self.hot) <= (2 * keep if threshold is None else threshold) or len(self.hot) <= keep:
+            return
+        moving = len(self.hot) - keep
+        # Segments past cold_len belong to a longer history this one is a
+        #   prefix of; the new segment starts at cold_len and hides them.
+        live = bisect.bisect_left(self.starts, self.cold_len)
+        self.segments = self.segments[:live] + (self.store.put(self.hot[:moving]),)
+        self.starts = self.starts[:live] + (self.cold_len,)
+        self.cold_len += moving
+        self.hot = self.hot[moving:]
+
+    def __reduce__(self):
+        # Checkpoints hold plain lists, so they do not depend on the store.
+        return (list, (list(self),))
@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+
+from lexer  import *
+from parser import *
+
+# Watch mode. A Watcher keeps a program file parsed, a piece at a time: the
+#   file is cut where statements are bound to end (see split_program), and
+#   when it changes, only the pieces between the longest unchanged run at its
+#   start and the longest at its end are parsed again. The statements of the
+#   pieces after the change keep their indexes too, unless the change got
+#   indexing there into another state (see reindex_from).
+
+class Piece:
+    def __init__(self, text, line, statements):
+        self.text = text                # bytes of the piece
+        self.line = line                # line it starts on
+        self.statements = statements    # its Assignments, None if it failed
+
+class Watcher:
+    """
+    Parses the program file at path again whenever it changes (see update
+    and wait). The file is read rather than memory-mapped, since an editor
+    may truncate it while it is mapped.
+    """
+    def __init__(self, path, interval=0.25):
+        self.path = path
+        self.interval = interval
+        self.pieces = []
+        self.statements = None  # as last indexed, if the pieces are still those
+        self.marks = {}         # see reindex_from
+        self.stamp = None       # what the file looked like when last read
+        self.text = b''
+
+    def _stamp(self):
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        return (info.st_mtime_ns, info.st_size, info.st_ino)
+
+    def wait(self):
+        # Returns once the file is not what it was when last read.
+        while True:
+            stamp = self._stamp()
+            if stamp is not None and stamp != self.stamp:
+                return
+            time.sleep(self.interval)
+
+    def lines(self):
+        # The text last read, split into lines, for ParseFailure.show.
+        return self.text.decode('utf-8', 'replace').replace('\r\n', '\n').split('\n')
+
+    def update(self):
+        """
+        Reads the file and parses what changed. Returns the statements, and
+        the number of mutations of each name, as reindex would; or the first
+        ParseFailure.
+        """
+        self.stamp = self._stamp()
+        with open(self.path, 'rb') as fh:
+            self.text = fh.read()
+        cuts = split_program(self.text, 1)
+        texts = [self.text[start:end] for start, end, _ in cuts]
+
+        old = self.pieces
+        head = 0
+        while head < min(len(old), len(texts)) and old[head].text == texts[head] \
+                and old[head].statements is not None:
+            head += 1
+        tail = 0
+        while tail < min(len(old), len(texts)) - head and old[-1 - tail].text == texts[-1 - tail] \
+                and old[-1 - tail].statements is not None:
+            tail += 1
+
+        pieces = old[:head]
+        failure = None
+        for k in range(head, len(texts) - tail):
+            line = cuts[k][2]
+            result = parse_program(TokenStream.of(Source(self.path, data=texts[k]), line))
+            if isinstance(result, ParseFailure):
+                failure = failure or result
+                result = None
+            pieces.append(Piece(texts[k], line, result))
+        kept = old[len(old) - tail:]
+        for k, piece in enumerate(kept, len(texts) - tail):
+            shift = cuts[k][2] - piece.line
+            if shift:
+                piece.line += shift
+                for assn in piece.statements:
+                    assn.line += shift
+        pieces += kept
+
+        self.pieces = pieces
+        if failure is not None:
+            # What was indexed no longer lines up with the pieces.
+            self.statements = None
+            self.marks = {}
+            return failure
+
+        statements = []
+        for piece in pieces:
+            statements += piece.statements
+        start = sum(len(p.statements) for p in pieces[:head])
+        stop = None
+        if self.statements is not None and kept:
+            # The marks of the statements kept, moved to where they are now.
+            after = sum(len(p.statements) for p in kept)
+            shift = len(statements) - len(self.statements)
+            stop = {k + shift: state for k, state in self.marks.items() if k >= len(self.statements) - after}
+        else:
+            self.marks = {}
+        self.statements = statements
+        count = reindex_from(statements, self.marks, start, stop)
+        parsed = len(statements) - start - sum(len(p.statements) for p in kept)
+        print(f"\x1B[2mparsed {parsed} of {len(statements)} statements\x1B[22m", file=sys.stderr)
+        return statements, count